@@ -0,0 +1,19 @@
+#
+# Copyright 2016, roberto@zenvoid.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# Benchmarks of the conversion tools, run from the top directory with:
+#
+#   python3 -m benchmarks [options]
+#
+# Synthetic sound banks are created by the generate module, and each phase of
+# the conversion is timed by the phases module.
@@ -0,0 +1,109 @@
+#
+# Copyright 2016, roberto@zenvoid.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+import sys, os, os.path, json, platform, resource, tempfile, argparse, logging
+logging.basicConfig(level=logging.WARNING, format='%(levelname)s: %(message)s')
+
+import soundfile
+import numpy
+from benchmarks.generate import generateSamples, generateSFZ
+from benchmarks.phases import phaseNames, runPhases
+
+parser = argparse.ArgumentParser(prog='python3 -m benchmarks',
+	description="Convert a synthetic sound bank and report the time and memory used by each phase as JSON.")
+parser.add_argument('--instruments', metavar='N', type=int, default=4,
+	help="number of instruments (default: 4)")
+parser.add_argument('--groups', metavar='N', type=int, default=4,
+	help="number of groups of each instrument (default: 4)")
+parser.add_argument('--regions', metavar='N', type=int, default=88,
+	help="number of regions of each group (default: 88)")
+parser.add_argument('--random-groups', metavar='N', type=int, default=0,
+	help="number of groups of each instrument with RandomRegion (default: 0)")
+parser.add_argument('--samples', metavar='N', type=int, default=88,
+	help="number of distinct audio samples (default: 88)")
+parser.add_argument('--frames', metavar='N', type=int, default=44100,
+	help="length of each audio sample in frames (default: 44100)")
+parser.add_argument('--channels', metavar='N', type=int, choices=[1, 2], default=1,
+	help="channels of each audio sample (default: 1)")
+parser.add_argument('--rate', metavar='HZ', type=int, default=44100,
+	help="sample rate of audio samples (default: 44100)")
+parser.add_argument('--format', choices=['wav', 'flac'], default='wav',
+	help="format of audio samples (default: wav)")
+parser.add_argument('--stream', action='store_true',
+	help="write SF2 sample data in streaming mode")
+parser.add_argument('--jobs', metavar='N', type=int, default=1,
+	help="decode up to N audio samples in parallel (default: 1)")
+parser.add_argument('--parse-only', action='store_true',
+	help="only time importSFZ, which parses the SFZ file")
+parser.add_argument('--repeat', metavar='N', type=int, default=3,
+	help="run the conversion N times and report the fastest time of each phase (default: 3)")
+parser.add_argument('--dir', metavar='DIR',
+	help="create the sound bank and output files in DIR and keep them (default: a temporary directory)")
+parser.add_argument('--output', metavar='FILE',
+	help="write the JSON report to FILE (default: standard output)")
+args = parser.parse_args()
+
+tmpDir = None
+path = args.dir
+if path == None:
+	tmpDir = tempfile.TemporaryDirectory(prefix = 'freepats-benchmark-')
+	path = tmpDir.name
+os.makedirs(path, exist_ok = True)
+
+sampleNames = generateSamples(path, args.samples, args.frames, args.channels, args.rate, args.format)
+sfzFile = os.path.join(path, 'input.sfz')
+generateSFZ(sfzFile, sampleNames, args.instruments, args.groups, args.regions, args.random_groups)
+
+names = phaseNames
+if args.parse_only:
+	names = phaseNames[0:1]
+runs = [runPhases(sfzFile, path, args.stream, args.jobs, names = names) for i in range(0, max(1, args.repeat))]
+memory = runPhases(sfzFile, path, args.stream, args.jobs, traceMemory = True, names = names)
+
+regions = args.instruments * args.groups * args.regions
+usedSamples = min(args.samples, regions)
+phases = {}
+for name in names:
+	times = [run[name] for run in runs]
+	phases[name] = {'seconds': min(times), 'runs': times, 'peakMemory': memory[name]}
+phases['importSFZ']['regionsPerSecond'] = regions / phases['importSFZ']['seconds']
+if not args.stream and not args.parse_only:
+	frames = usedSamples * args.frames * args.channels
+	phases['sfSdta']['framesPerSecond'] = frames / phases['sfSdta']['seconds']
+
+report = {
+	'config': {key: value for key, value in vars(args).items() if key not in ('dir', 'output')},
+	'environment': {
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'cpus': os.cpu_count(),
+		'numpy': numpy.__version__,
+		'soundfile': soundfile.__version__,
+		'libsndfile': soundfile.__libsndfile_version__
+	},
+	'phases': phases,
+	'peakRSS': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+}
+if not args.parse_only:
+	report['sf2Size'] = os.path.getsize(os.path.join(path, 'benchmark.sf2'))
+
+if args.output:
+	with open(args.output, 'w') as outFile:
+		json.dump(report, outFile, indent = 2)
+		outFile.write('\n')
+else:
+	json.dump(report, sys.stdout, indent = 2)
+	sys.stdout.write('\n')
+
+if tmpDir:
+	tmpDir.cleanup()
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+#
+# Copyright 2016, roberto@zenvoid.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# Compares memory use and traversal time of the dict sound bank model with
+# the compact one (see compactbank.py), on a synthetic sound bank.
+
+import sys, os.path, time, tracemalloc, argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from compactbank import compactSoundBank
+from sf2 import SF2
+
+parser = argparse.ArgumentParser(description="Benchmark the compact sound bank model.")
+parser.add_argument('--regions', metavar='N', type=int, default=100000,
+	help="number of regions of the synthetic sound bank (default: 100000)")
+parser.add_argument('--samples', metavar='N', type=int, default=1000,
+	help="number of distinct audio samples (default: 1000)")
+args = parser.parse_args()
+
+
+def createSoundBank():
+	# Regions similar to those read from SFZ files: key and velocity ranges,
+	# loop points and a few other opcodes
+	instruments = []
+	regionsPerGroup = 128
+	regionCount = 0
+	while regionCount < args.regions:
+		groups = []
+		for lovel in range(1, 128, 32):
+			regions = []
+			for key in range(0, regionsPerGroup):
+				if regionCount == args.regions:
+					break
+				regions.append({
+					'sample': os.path.normpath('samples/note_{}.flac'.format(regionCount % args.samples)),
+					'lokey': key, 'hikey': key, 'pitch_keycenter': key,
+					'lovel': lovel, 'hivel': min(lovel + 31, 127),
+					'loop_start': 1000 + key, 'loop_end': 20000 + key,
+					'loop_mode': 'loop_continuous', 'tune': key % 10 - 5,
+					'volume': -3.5, 'ampeg_release': 0.5})
+				regionCount += 1
+			if len(regions) > 0:
+				groups.append({'regions': regions})
+		instruments.append({'Instrument': 'Instrument {}'.format(len(instruments)), 'groups': groups})
+	return {'instruments': instruments}
+
+
+def measureMemory(compact):
+	tracemalloc.start()
+	soundBank = createSoundBank()
+	if compact:
+		compactSoundBank(soundBank)
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return soundBank, size
+
+
+def walk(soundBank):
+	total = 0
+	for instrument in soundBank['instruments']:
+		for group in instrument['groups']:
+			for region in group['regions']:
+				if 'sample' in region.keys():
+					total += region['hikey'] - region['lokey'] + region['loop_end']
+	return total
+
+
+def walkColumns(soundBank):
+	# Same as walk, reading whole columns of CompactRegions
+	total = 0
+	for instrument in soundBank['instruments']:
+		for group in instrument['groups']:
+			regions = group['regions']
+			hikey, bit = regions.column('hikey')
+			lokey, bit = regions.column('lokey')
+			loopEnd, bit = regions.column('loop_end')
+			for i in range(0, len(regions)):
+				if regions.samples[i] >= 0:
+					total += hikey[i] - lokey[i] + loopEnd[i]
+	return total
+
+
+def resolve(soundBank):
+	sf2 = SF2()
+	sf2.soundBank = soundBank
+	sf2.resolveOpcodes()
+	return sf2
+
+
+def resolveWalk(soundBank):
+	# Read a few opcodes of every region as the SF2 exporter does, through
+	# the views created by resolveOpcodes
+	sf2 = resolve(soundBank)
+	total = 0
+	for instrument in soundBank['instruments']:
+		for group in instrument['groups']:
+			for opcodes, localOpcodes in sf2.regionOpcodes[id(group)]:
+				if opcodes.get('sample'):
+					total += opcodes.get('hikey', 127) - opcodes.get('lokey', 0) + opcodes.get('loop_end', 0)
+				sf2.createGenList(localOpcodes)
+	return total
+
+
+def measureResolveMemory(soundBank):
+	# Memory held by the views of resolveOpcodes
+	tracemalloc.start()
+	sf2 = resolve(soundBank)
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return size
+
+
+def measureTime(function, soundBank):
+	start = time.perf_counter()
+	function(soundBank)
+	return time.perf_counter() - start
+
+
+print("{} regions, {} samples".format(args.regions, args.samples))
+print("{:<8} {:>12} {:>10} {:>12} {:>12} {:>14} {:>16}".format('model', 'memory (MB)', 'walk (s)',
+	'columns (s)', 'resolve (s)', 'resolved (MB)', 'resolved walk (s)'))
+for compact in (False, True):
+	soundBank, size = measureMemory(compact)
+	columns = '-'
+	if compact:
+		columns = '{:.3f}'.format(measureTime(walkColumns, soundBank))
+	print("{:<8} {:>12.1f} {:>10.3f} {:>12} {:>12.3f} {:>14.1f} {:>16.3f}".format('compact' if compact else 'dict',
+		size / 1024 / 1024, measureTime(walk, soundBank), columns, measureTime(resolve, soundBank),
+		measureResolveMemory(soundBank) / 1024 / 1024, measureTime(resolveWalk, soundBank)))
+	del soundBank
@@ -0,0 +1,69 @@
+#
+# Copyright 2016, roberto@zenvoid.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# Synthetic sound banks for benchmarks. The same arguments always create the
+# same files, so results of different runs can be compared.
+
+import os.path
+import soundfile
+import numpy
+
+
+def generateSamples(path, count, frames = 44100, channels = 1, rate = 44100, fileFormat = 'wav'):
+	# Write count audio files with a decaying tone plus some noise, which
+	# is compressed by FLAC like real recordings. Returns their file names,
+	# relative to path.
+	random = numpy.random.RandomState(count)
+	fileNames = []
+	time = numpy.arange(0, frames) / rate
+	envelope = numpy.exp(-3 * time)
+	for i in range(0, count):
+		frequency = 110 * 2 ** ((i % 48) / 12)
+		tone = numpy.sin(2 * numpy.pi * frequency * time) * envelope * 0.5
+		data = numpy.empty((frames, channels))
+		for ch in range(0, channels):
+			data[:, ch] = tone + random.uniform(-0.01, 0.01, frames)
+		fileName = 'sample{:05d}.{}'.format(i, fileFormat)
+		soundfile.write(os.path.join(path, fileName), data, rate, subtype = 'PCM_16')
+		fileNames.append(fileName)
+	return fileNames
+
+
+def generateSFZ(fileName, sampleNames, instruments = 1, groups = 1, regions = 88, randomGroups = 0):
+	# Write a SFZ file where each instrument has the given number of groups
+	# with that number of regions each. The first randomGroups groups of each
+	# instrument are RandomRegion groups. Regions use samples in turn.
+	sampleIndex = 0
+	with open(fileName, 'w') as outFile:
+		outFile.write('//+ Name: Benchmark\n')
+		outFile.write('//+ Date: 2016-12-19\n')
+		for inst in range(0, instruments):
+			outFile.write('\n<global>\n')
+			outFile.write(' //+ Instrument: Instrument {}\n'.format(inst))
+			outFile.write(' //+ Program: {}\n'.format(inst % 128 + 1))
+			outFile.write(' ampeg_release=0.5 volume=-3\n')
+			for group in range(0, groups):
+				outFile.write('\n<group>\n')
+				if group < randomGroups:
+					outFile.write(' //+ RandomRegion: Yes\n')
+					outFile.write(' lovel=1 hivel=127\n')
+				else:
+					lovel = group * 128 // groups
+					hivel = (group + 1) * 128 // groups - 1
+					outFile.write(' lovel={} hivel={}\n'.format(max(lovel, 1), hivel))
+				outFile.write(' loop_mode=no_loop\n')
+				for region in range(0, regions):
+					key = 21 + region * 88 // regions
+					outFile.write('<region> lokey={} hikey={} pitch_keycenter={} sample={}\n'.format(
+						key, key, key, sampleNames[sampleIndex % len(sampleNames)]))
+					sampleIndex += 1
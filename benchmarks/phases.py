@@ -0,0 +1,73 @@
+#
+# Copyright 2016, roberto@zenvoid.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# Runs the phases of a SFZ to SF2 conversion (and SFZ export) one by one,
+# timing each of them. When memory is traced, the peak of Python allocations
+# during each phase is recorded instead, since tracing slows them down.
+
+import os.path, time, tracemalloc
+from sfz import SFZ
+from sf2 import SF2
+
+phaseNames = ['importSFZ', 'sfSdta', 'sfPdta', 'exportChunks', 'exportSFZ']
+
+
+def runPhases(sfzFile, outPath, stream = False, jobs = 1, traceMemory = False, names = phaseNames):
+	# Returns a dict with the seconds or peak memory of each phase, running
+	# only the first ones given by names
+	results = {}
+	state = {}
+
+	def importSFZ():
+		sfz = SFZ()
+		if not sfz.importSFZ(sfzFile):
+			raise RuntimeError("Can not import {}".format(sfzFile))
+		state['soundBank'] = sfz.soundBank
+
+	def sfSdta():
+		sf2 = SF2()
+		sf2.initExport(state['soundBank'], stream = stream, jobs = jobs)
+		sf2.outFile = open(os.path.join(outPath, 'benchmark.sf2'), 'wb')
+		state['sf2'] = sf2
+		state['info'] = sf2.sfInfo()
+		state['sdta'] = sf2.sfSdta()
+
+	def sfPdta():
+		# In streaming mode, shdr records are not known until sample data
+		# has been written, so pdta is created within exportChunks
+		if not stream:
+			state['pdta'] = state['sf2'].sfPdta()
+		else:
+			state['pdta'] = state['sf2'].sfPdta
+
+	def exportChunks():
+		sf2 = state['sf2']
+		sf2.exportChunks([[[b'RIFF', b'sfbk'], [state['info'], state['sdta'], state['pdta']]]])
+		sf2.outFile.close()
+
+	def exportSFZ():
+		sfz = SFZ()
+		sfz.soundBank = state['soundBank']
+		sfz.exportSFZ(os.path.join(outPath, 'benchmark.sfz'))
+
+	for name, phase in zip(names, [importSFZ, sfSdta, sfPdta, exportChunks, exportSFZ]):
+		if traceMemory:
+			tracemalloc.start()
+			phase()
+			results[name] = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+		else:
+			start = time.perf_counter()
+			phase()
+			results[name] = time.perf_counter() - start
+	return results
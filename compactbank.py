@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+#
+# Copyright 2016, roberto@zenvoid.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# Compact storage of the regions of a group, for very large sound banks.
+#
+# Instead of a dict per region, the most common opcodes are stored in typed
+# arrays (one item per region), sample file names are stored once in a table
+# shared by all groups, and any other opcode is kept in a dict only for the
+# regions which have it. Regions are read through CompactRegion, a read only
+# mapping which behaves like the dict it replaces, so a group can hold either
+# a list of dicts or a CompactRegions object in 'regions'.
+#
+# The SF2 exporter reads each region over the opcodes it inherits through
+# ResolvedRegions, which keeps one dict per group and reads the columns, so
+# that no dict is created for each region.
+
+import array, collections.abc
+from opcodes import sfzOpcodes
+
+# Returned by CompactRegions.value for opcodes which are not set
+missing = object()
+
+
+class SampleTable:
+
+	def __init__(self):
+		self.names = []
+		self.index = {}
+
+
+	def add(self, name):
+		sampleIndex = self.index.get(name)
+		if sampleIndex == None:
+			sampleIndex = len(self.names)
+			self.names.append(name)
+			self.index[name] = sampleIndex
+		return sampleIndex
+
+
+class CompactRegions(collections.abc.Sequence):
+
+	# Every numeric or enum opcode of the registry has a bit in the present
+	# array of each region, and a column which is created the first time the
+	# opcode is used. Enum opcodes store the index of their value.
+	columnBits = {}
+	columnTypes = {}
+	for opcode, spec in sfzOpcodes.items():
+		if spec['type'] in ('note', 'enum'):
+			columnTypes[opcode] = 'b'
+		elif spec['type'] == 'int':
+			if spec['min'] >= -0x80 and spec['max'] < 0x80:
+				columnTypes[opcode] = 'b'
+			elif spec['min'] >= -0x8000 and spec['max'] < 0x8000:
+				columnTypes[opcode] = 'h'
+			else:
+				columnTypes[opcode] = 'q'
+		elif spec['type'] == 'float':
+			columnTypes[opcode] = 'd'
+		else:
+			continue
+		columnBits[opcode] = 1 << len(columnBits)
+	enumValues = {opcode: spec['values'] for opcode, spec in sfzOpcodes.items() if spec['type'] == 'enum'}
+	del opcode, spec
+
+	def __init__(self, sampleTable = None, regions = ()):
+		if sampleTable == None:
+			sampleTable = SampleTable()
+		self.sampleTable = sampleTable
+		self.columns = {}
+		self.present = array.array('Q')
+		self.samples = array.array('i')
+		self.extra = {}
+		for region in regions:
+			self.append(region)
+
+
+	def append(self, region):
+		regionIndex = len(self.present)
+		present = 0
+		sampleIndex = -1
+		for opcode, value in region.items():
+			bit = CompactRegions.columnBits.get(opcode)
+			if bit != None:
+				column = self.columns.get(opcode)
+				if column == None:
+					column = array.array(CompactRegions.columnTypes[opcode], bytes(
+						regionIndex * array.array(CompactRegions.columnTypes[opcode]).itemsize))
+					self.columns[opcode] = column
+				if opcode in CompactRegions.enumValues:
+					value = CompactRegions.enumValues[opcode].index(value)
+				column.append(value)
+				present |= bit
+			elif opcode == 'sample':
+				sampleIndex = self.sampleTable.add(value)
+			else:
+				self.extra.setdefault(regionIndex, {})[opcode] = value
+
+		# Columns of opcodes not used in this region are padded
+		regionCount = regionIndex + 1
+		for column in self.columns.values():
+			if len(column) < regionCount:
+				column.append(0)
+		self.present.append(present)
+		self.samples.append(sampleIndex)
+
+
+	def __len__(self):
+		return len(self.present)
+
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(len(self)))]
+		if index < 0:
+			index += len(self)
+		if index < 0 or index >= len(self):
+			raise IndexError('region index out of range')
+		return CompactRegion(self, index)
+
+
+	def column(self, opcode):
+		# Array with the values of an opcode in all regions, and the bit set in
+		# present for the regions which have it
+		column = self.columns.get(opcode)
+		if column == None:
+			column = array.array(CompactRegions.columnTypes[opcode], bytes(
+				len(self) * array.array(CompactRegions.columnTypes[opcode]).itemsize))
+		return column, CompactRegions.columnBits[opcode]
+
+
+	def opcode(self, index, opcode):
+		# Value of an opcode in a region, raises KeyError if not set
+		value = self.value(index, opcode)
+		if value is missing:
+			raise KeyError(opcode)
+		return value
+
+
+	def value(self, index, opcode, default = missing):
+		# Value of an opcode in a region, or default if not set
+		bit = CompactRegions.columnBits.get(opcode)
+		if bit != None:
+			if not self.present[index] & bit:
+				return default
+			value = self.columns[opcode][index]
+			if opcode in CompactRegions.enumValues:
+				value = CompactRegions.enumValues[opcode][value]
+			return value
+		if opcode == 'sample':
+			sampleIndex = self.samples[index]
+			if sampleIndex < 0:
+				return default
+			return self.sampleTable.names[sampleIndex]
+		extra = self.extra.get(index)
+		if extra == None:
+			return default
+		return extra.get(opcode, default)
+
+
+	def opcodeNames(self, index):
+		present = self.present[index]
+		names = [opcode for opcode in self.columns.keys() if present & CompactRegions.columnBits[opcode]]
+		if self.samples[index] >= 0:
+			names.append('sample')
+		if index in self.extra:
+			names.extend(self.extra[index].keys())
+		return names
+
+
+class CompactRegion(collections.abc.Mapping):
+
+	__slots__ = ('regions', 'index')
+
+	def __init__(self, regions, index):
+		self.regions = regions
+		self.index = index
+
+
+	def __getitem__(self, opcode):
+		return self.regions.opcode(self.index, opcode)
+
+
+	def get(self, opcode, default = None):
+		return self.regions.value(self.index, opcode, default)
+
+
+	def __contains__(self, opcode):
+		return self.regions.value(self.index, opcode) is not missing
+
+
+	def __iter__(self):
+		return iter(self.regions.opcodeNames(self.index))
+
+
+	def __len__(self):
+		return len(self.regions.opcodeNames(self.index))
+
+
+	def __repr__(self):
+		return repr(dict(self))
+
+
+class ResolvedRegions(collections.abc.Sequence):
+
+	# Pairs of views of each region of CompactRegions, as created by
+	# SF2.resolveOpcodes: one over all the opcodes inherited by the region,
+	# and another one over those of its group only. Views are created on
+	# access.
+
+	def __init__(self, regions, opcodes, localOpcodes):
+		self.regions = regions
+		self.opcodes = opcodes
+		self.localOpcodes = localOpcodes
+
+
+	def __len__(self):
+		return len(self.regions)
+
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(len(self)))]
+		if index < 0:
+			index += len(self)
+		if index < 0 or index >= len(self):
+			raise IndexError('region index out of range')
+		return (ResolvedRegion(self.regions, index, self.opcodes),
+			ResolvedRegion(self.regions, index, self.localOpcodes))
+
+
+	def __iter__(self):
+		for index in range(0, len(self.regions)):
+			yield (ResolvedRegion(self.regions, index, self.opcodes),
+				ResolvedRegion(self.regions, index, self.localOpcodes))
+
+
+class ResolvedRegion(collections.abc.Mapping):
+
+	# Opcodes of a region, over those of the inherited dict
+
+	__slots__ = ('regions', 'index', 'inherited')
+
+	def __init__(self, regions, index, inherited):
+		self.regions = regions
+		self.index = index
+		self.inherited = inherited
+
+
+	def get(self, opcode, default = None):
+		value = self.regions.value(self.index, opcode)
+		if value is missing:
+			return self.inherited.get(opcode, default)
+		return value
+
+
+	def __getitem__(self, opcode):
+		value = self.get(opcode, missing)
+		if value is missing:
+			raise KeyError(opcode)
+		return value
+
+
+	def __contains__(self, opcode):
+		return self.get(opcode, missing) is not missing
+
+
+	def __iter__(self):
+		names = self.regions.opcodeNames(self.index)
+		return iter(names + [opcode for opcode in self.inherited.keys() if not opcode in names])
+
+
+	def __len__(self):
+		return len(list(iter(self)))
+
+
+	def __repr__(self):
+		return repr(dict(self))
+
+
+def compactSoundBank(soundBank):
+	# Replace the list of region dicts of every group with CompactRegions,
+	# sharing a single sample table
+	sampleTable = SampleTable()
+	for instrument in soundBank['instruments']:
+		for group in instrument['groups']:
+			group['regions'] = CompactRegions(sampleTable, group['regions'])
+	return soundBank
@@ -15,74 +15,475 @@
 import sys, logging
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
-import re, textwrap
+import re, os, os.path, textwrap, argparse, shlex, tempfile, time
+import concurrent.futures
 from sfz import SFZ
 from sf2 import SF2
+from samplecache import SampleCache, MemorySampleCache, ReadOnlySampleCache
+from stats import Stats
 
-inputFormats = ['sfz']
-outputFormats = ['sfz', 'sf2']
+inputFormats = ['sfz', 'sf2']
+outputFormats = ['sfz', 'sf2', 'sf3']
 
-if len(sys.argv) < 3:
-	print("Usage:", sys.argv[0], "INPUT OUTPUT\n")
-	print(textwrap.dedent("""
+parser = argparse.ArgumentParser(
+	formatter_class=argparse.RawDescriptionHelpFormatter,
+	usage="%(prog)s [options] INPUT OUTPUT [INPUT OUTPUT ...]\n       %(prog)s --check [options] INPUT [INPUT ...]",
+	description=textwrap.dedent("""
 		Process INPUT sound bank and writes an OUTPUT file, which can be in different
 		format. It tries to guess formats from file names. Supported formats in this
 		version:
-	""").strip())
-	print("")
-	print("    Input:", ", ".join(inputFormats).upper())
-	print("    Output:", ", ".join(outputFormats).upper())
-	print("")
-	print(textwrap.dedent("""
+	""").strip() + "\n\n" +
+		"    Input: " + ", ".join(inputFormats).upper() + "\n" +
+		"    Output: " + ", ".join(outputFormats).upper(),
+	epilog=textwrap.dedent("""
 		This program supports a limited subset of the SFZ format, extended with
 		annotations which enable better control of the generated output files.
+
+		Many sound banks can be converted at once, giving several INPUT OUTPUT
+		pairs or a manifest file with one pair per line. They are converted in
+		parallel, and audio samples used by more than one sound bank are decoded
+		only once.
 	""").strip())
-	sys.exit(1)
-
-inputFile = sys.argv[1]
-inputFormat = None
-outputFile = sys.argv[2]
-outputFormat = None
-soundBank = None
-
-match = re.search('\.([a-z0-9]+)$', inputFile.lower())
-if match:
-	inputFormat = match.group(1)
-else:
-	logging.error("Can not guess format from file name: {}".format(inputFile))
-	sys.exit(1)
-
-if not inputFormat in inputFormats:
-	logging.error("Unknown or unsupported input format: {}".format(inputFormat))
-	sys.exit(1)
-
-match = re.search('\.([a-z0-9]+)$', outputFile.lower())
-if match:
-	outputFormat = match.group(1)
-else:
-	logging.error("Can not guess format from file name: {}".format(outputFile))
-	sys.exit(1)
-
-if not outputFormat in outputFormats:
-	logging.error("Unknown or unsupported output format: {}".format(outputFormat))
-	sys.exit(1)
-
-print("Reading and processing input file...")
-if inputFormat == 'sfz':
+parser.add_argument('files', metavar='INPUT OUTPUT', nargs='*', help=argparse.SUPPRESS)
+parser.add_argument('--stream', action='store_true',
+	help="write SF2 sample data block by block, without holding it in memory")
+parser.add_argument('--jobs', metavar='N', type=int, default=1,
+	help="decode, encode or extract up to N audio samples in parallel (default: 1)")
+parser.add_argument('--cache', action='store_true',
+	help="reuse decoded audio samples stored in the sample cache")
+parser.add_argument('--cache-dir', metavar='DIR',
+	help="directory of the sample cache, implies --cache (default: ~/.cache/freepats-tools/samples)")
+parser.add_argument('--cache-size', metavar='MB', type=int, default=2048,
+	help="maximum size of the sample cache (default: 2048)")
+parser.add_argument('--incremental', action='store_true',
+	help="copy SF2 sample data from an existing OUTPUT file when audio samples have not changed")
+parser.add_argument('--bits', metavar='N', type=int, choices=[16, 24], default=16,
+	help="size of SF2 sample data, 24 bits are stored in a sm24 chunk as in SF2 2.04 (default: 16)")
+parser.add_argument('--quality', metavar='Q', type=float, default=0.6,
+	help="quality of the Ogg Vorbis sample data of SF3 files, from 0 to 1 (default: 0.6)")
+parser.add_argument('--trim-silence', metavar='DB', type=float,
+	help="remove silence below DB decibels (for example -60) from the start and the end of audio samples")
+parser.add_argument('--find-loops', action='store_true',
+	help="search loop points of looped audio samples which do not set loop_start and loop_end")
+parser.add_argument('--dedup', action='store_true',
+	help="store only once audio samples with identical data and loop information")
+parser.add_argument('--compact', action='store_true',
+	help="store SFZ regions in typed arrays, which uses less memory on very large sound banks")
+parser.add_argument('--manifest', metavar='FILE',
+	help="convert the INPUT OUTPUT pairs listed in FILE, one per line")
+parser.add_argument('--processes', metavar='N', type=int, default=os.cpu_count() or 1,
+	help="convert up to N sound banks at once (default: number of CPUs)")
+parser.add_argument('--check', action='store_true',
+	help="only check that each INPUT SFZ file can be converted to SF2, reading just the headers of its audio samples")
+parser.add_argument('--watch', action='store_true',
+	help="keep running and write OUTPUT again each time an SFZ INPUT or its audio samples are modified")
+parser.add_argument('--stats', metavar='FILE',
+	help="write time, data processed and peak memory of each phase to FILE as JSON ('-' for standard output, which leaves out progress messages)")
+parser.add_argument('--profile', metavar='PHASE',
+	help="profile PHASE (importSFZ, importSF2, sfSdta, decode, analyze, sfPdta, exportChunks, exportSFZ, exportSamples) with cProfile")
+parser.add_argument('--profile-output', metavar='FILE',
+	help="write profile data to FILE, which can be read with pstats (default: PHASE.prof)")
+
+# Seconds between checks for modified files in watch mode
+watchInterval = 0.2
+
+# Audio file headers read at once in check mode
+checkThreads = 16
+
+
+def guessFormat(fileName, formats, direction):
+	match = re.search(r'\.([a-z0-9]+)$', fileName.lower())
+	if not match:
+		logging.error("Can not guess format from file name: {}".format(fileName))
+		return None
+	fileFormat = match.group(1)
+	if not fileFormat in formats:
+		logging.error("Unknown or unsupported {} format: {}".format(direction, fileFormat))
+		return None
+	return fileFormat
+
+
+def checkFormats(inputFile, outputFile):
+	inputFormat = guessFormat(inputFile, inputFormats, 'input')
+	if inputFormat == None:
+		return None
+	outputFormat = guessFormat(outputFile, outputFormats, 'output')
+	if outputFormat == None:
+		return None
+	if inputFormat == 'sf2' and outputFormat != 'sfz':
+		logging.error("Conversion from {} to {} is not supported".format(inputFormat, outputFormat))
+		return None
+	return inputFormat, outputFormat
+
+
+def createCache(path, size):
+	try:
+		return SampleCache(path, size)
+	except OSError:
+		logging.error("Can not create sample cache directory: {}".format(path))
+		return None
+
+
+def convert(args, inputFile, outputFile, cache = None, verbose = True, stats = None):
+	formats = checkFormats(inputFile, outputFile)
+	if formats == None:
+		return False
+	inputFormat, outputFormat = formats
+
+	if verbose:
+		print("Reading and processing input file...")
+	if inputFormat == 'sfz':
+		sfz = SFZ()
+		sfz.stats = stats
+		if not sfz.importSFZ(inputFile, compact = args.compact):
+			return False
+		soundBank = sfz.soundBank
+	elif inputFormat == 'sf2':
+		inputSF2 = SF2()
+		inputSF2.stats = stats
+		if not inputSF2.importSF2(inputFile):
+			return False
+		soundBank = inputSF2.soundBank
+
+	if verbose:
+		print("Writing output file...")
+	if outputFormat == 'sfz':
+		sfz = SFZ()
+		sfz.stats = stats
+		sfz.soundBank = soundBank
+		if not sfz.exportSFZ(outputFile):
+			return False
+		if inputFormat == 'sf2':
+			# Audio samples are written next to the SFZ file
+			if verbose:
+				print("Extracting audio samples...")
+			if not inputSF2.exportSamples(os.path.dirname(outputFile), args.jobs):
+				return False
+	elif outputFormat in ('sf2', 'sf3'):
+		sf2 = SF2()
+		sf2.stats = stats
+		if not sf2.exportSF2(soundBank, outputFile, stream = args.stream, jobs = args.jobs, cache = cache,
+			incremental = args.incremental, dedup = args.dedup, bits = args.bits,
+			quality = sf3Quality(args, outputFormat), trimSilence = args.trim_silence,
+			findLoops = args.find_loops):
+			return False
+	return True
+
+
+def sf3Quality(args, outputFormat):
+	# SF3 files are written by SF2.exportSF2 when a quality is given
+	if outputFormat == 'sf3':
+		return args.quality
+	return None
+
+
+def check(args, inputFile):
+	# Check a SFZ sound bank without decoding its audio samples
+	if guessFormat(inputFile, ['sfz'], 'input') == None:
+		return False
 	sfz = SFZ()
-	if not sfz.importSFZ(sys.argv[1]):
-		sys.exit(1)
-	soundBank = sfz.soundBank
+	if not sfz.importSFZ(inputFile, compact = args.compact):
+		return False
+	return SF2().checkSF2(sfz.soundBank, max(args.jobs, checkThreads))
+
+
+def runCheck(args, inputFiles):
+	failed = 0
+	for inputFile in inputFiles:
+		if check(args, inputFile):
+			print("OK      {}".format(inputFile))
+		else:
+			print("FAILED  {}".format(inputFile))
+			failed += 1
+	return failed == 0
+
+
+def readManifest(fileName):
+	# Each line holds an INPUT OUTPUT pair, quoted as in a shell if needed.
+	# Empty lines and lines starting with # are skipped.
+	pairs = []
+	try:
+		manifest = open(fileName, 'r')
+	except:
+		logging.error("Can not open file: {}".format(fileName))
+		return None
+	with manifest:
+		for lineNumber, line in enumerate(manifest, 1):
+			if not line.strip() or line.lstrip().startswith('#'):
+				continue
+			try:
+				files = shlex.split(line)
+			except ValueError:
+				files = []
+			if len(files) != 2:
+				logging.error("Error on line {} of file {}".format(lineNumber, fileName))
+				return None
+			pairs.append(files)
+	return pairs
+
+
+# Sample cache of each process of the batch pool, and the cache used when
+# converting, which only reads it unless --cache was given
+batchCache = None
+convertCache = None
+
+def initBatchProcess(cachePath, cacheSize, readOnly):
+	global batchCache, convertCache
+	batchCache = SampleCache(cachePath, cacheSize)
+	convertCache = batchCache
+	if readOnly:
+		convertCache = ReadOnlySampleCache(batchCache)
 
-print("Writing output file...")
-if outputFormat == 'sfz':
+
+def batchCacheSample(samplePath, bits):
+	try:
+		SF2().cacheSample(samplePath, batchCache, bits)
+	except Exception:
+		# The error is reported again when the sound bank is converted
+		pass
+
+
+def batchConvert(args, inputFile, outputFile):
+	try:
+		return convert(args, inputFile, outputFile, convertCache, verbose = False)
+	except Exception:
+		logging.exception("Failed to convert {}".format(inputFile))
+		return False
+
+
+def listSamples(args, inputFile):
+	# Audio files which will be decoded to convert a SFZ sound bank to SF2.
+	# Errors are not logged here, they are reported when it is converted.
 	sfz = SFZ()
-	sfz.soundBank = soundBank
-	if not sfz.exportSFZ(outputFile):
+	logging.disable(logging.ERROR)
+	try:
+		if not sfz.importSFZ(inputFile, compact = args.compact):
+			return []
+	finally:
+		logging.disable(logging.NOTSET)
+	return [os.path.abspath(samplePath) for samplePath in SF2().listSamples(sfz.soundBank)]
+
+
+def runBatch(args, pairs):
+	# Samples used by more than one sound bank are decoded first into the
+	# sample cache, so that every process reads them from there. Without
+	# --cache, a temporary cache is used for the duration of the batch, and
+	# it holds only those samples.
+	formats = [checkFormats(inputFile, outputFile) for inputFile, outputFile in pairs]
+	bankSamples = []
+	for (inputFile, outputFile), bankFormats in zip(pairs, formats):
+		if bankFormats in (('sfz', 'sf2'), ('sfz', 'sf3')):
+			bankSamples.append(listSamples(args, inputFile))
+		else:
+			bankSamples.append([])
+	useCount = {}
+	for samples in bankSamples:
+		for samplePath in set(samples):
+			useCount[samplePath] = useCount.get(samplePath, 0) + 1
+	sharedSamples = [samplePath for samplePath, count in useCount.items() if count > 1]
+
+	tmpCache = None
+	if args.cache:
+		cachePath = args.cache_dir
+		cacheSize = args.cache_size * 1024 * 1024
+		if createCache(cachePath, cacheSize) == None:
+			return False
+	else:
+		tmpCache = tempfile.TemporaryDirectory(prefix = 'convertSoundBank-')
+		cachePath = tmpCache.name
+		cacheSize = sys.maxsize
+
+	# Largest sound banks are started first, so that the pool is not left
+	# waiting for a long one at the end
+	def bankSize(index):
+		size = 0
+		for samplePath in bankSamples[index]:
+			try:
+				size += os.path.getsize(samplePath)
+			except OSError:
+				pass
+		return size
+	order = sorted(range(0, len(pairs)), key = bankSize, reverse = True)
+
+	results = [False] * len(pairs)
+	try:
+		with concurrent.futures.ProcessPoolExecutor(max_workers = max(1, args.processes),
+			initializer = initBatchProcess, initargs = (cachePath, cacheSize, tmpCache != None)) as pool:
+			if len(sharedSamples) > 0:
+				print("Decoding {} shared audio samples...".format(len(sharedSamples)))
+				list(pool.map(batchCacheSample, sharedSamples, [args.bits] * len(sharedSamples)))
+			print("Converting {} sound banks...".format(len(pairs)))
+			futures = {pool.submit(batchConvert, args, *pairs[index]): index for index in order
+				if formats[index] != None}
+			for future in concurrent.futures.as_completed(futures):
+				try:
+					results[futures[future]] = future.result()
+				except Exception:
+					logging.exception("Failed to convert {}".format(pairs[futures[future]][0]))
+	finally:
+		if tmpCache:
+			tmpCache.cleanup()
+
+	failed = 0
+	for (inputFile, outputFile), result in zip(pairs, results):
+		if result:
+			print("OK      {} -> {}".format(inputFile, outputFile))
+		else:
+			print("FAILED  {} -> {}".format(inputFile, outputFile))
+			failed += 1
+	print("{} of {} sound banks converted".format(len(pairs) - failed, len(pairs)))
+	return failed == 0
+
+
+def fileStates(fileNames):
+	states = {}
+	for fileName in fileNames:
+		try:
+			stat = os.stat(fileName)
+			states[fileName] = (stat.st_mtime_ns, stat.st_size)
+		except OSError:
+			states[fileName] = None
+	return states
+
+
+def watch(args, inputFile, outputFile):
+	# Convert INPUT each time it or one of its audio samples is modified. The
+	# sound bank is parsed again only when INPUT changes, and decoded audio
+	# samples are kept in memory while their files do not change, so only
+	# modified samples are decoded again.
+	inputFormat, outputFormat = checkFormats(inputFile, outputFile)
+	if inputFormat != 'sfz':
+		logging.error("Watch mode requires SFZ input")
+		return False
+
+	cache = MemorySampleCache(args.cache_size * 1024 * 1024)
+	soundBank = None
+	samplePaths = []
+	states = {}
+	print("Watching {} for changes, press Ctrl+C to stop".format(inputFile))
+	while True:
+		newStates = fileStates([inputFile] + samplePaths)
+		if newStates == states:
+			time.sleep(watchInterval)
+			continue
+
+		# Wait until files are no longer being written
+		time.sleep(watchInterval)
+		if fileStates(newStates.keys()) != newStates:
+			continue
+
+		start = time.perf_counter()
+		if newStates[inputFile] != states.get(inputFile):
+			sfz = SFZ()
+			soundBank = None
+			samplePaths = []
+			if sfz.importSFZ(inputFile, compact = args.compact):
+				soundBank = sfz.soundBank
+				if outputFormat != 'sfz':
+					samplePaths = SF2().listSamples(soundBank)
+			newStates.update(fileStates(samplePaths))
+		states = newStates
+		if soundBank == None:
+			continue
+
+		if outputFormat == 'sfz':
+			sfz = SFZ()
+			sfz.soundBank = soundBank
+			written = sfz.exportSFZ(outputFile)
+		else:
+			written = SF2().exportSF2(soundBank, outputFile, stream = args.stream, jobs = args.jobs,
+				cache = cache, dedup = args.dedup, bits = args.bits, quality = sf3Quality(args, outputFormat),
+				trimSilence = args.trim_silence, findLoops = args.find_loops)
+		if written:
+			print("{} written in {:.2f}s".format(outputFile, time.perf_counter() - start))
+
+
+def main():
+	args = parser.parse_args()
+	if args.cache_dir != None:
+		args.cache = True
+	# Statistics are only recorded when converting a single sound bank
+	statsOption = None
+	if args.stats:
+		statsOption = '--stats'
+	elif args.profile:
+		statsOption = '--profile'
+	if args.check:
+		if statsOption:
+			parser.error("{} can not be used with --check".format(statsOption))
+		# Only INPUT files are given, or a manifest whose OUTPUT files are
+		# ignored
+		inputFiles = list(args.files)
+		if args.manifest:
+			manifestPairs = readManifest(args.manifest)
+			if manifestPairs == None:
+				sys.exit(1)
+			inputFiles += [inputFile for inputFile, outputFile in manifestPairs]
+		if len(inputFiles) == 0:
+			parser.error("no INPUT files given")
+		if not runCheck(args, inputFiles):
+			sys.exit(1)
+		return
+
+	if len(args.files) % 2 != 0:
+		parser.error("INPUT and OUTPUT files must be given in pairs")
+	pairs = [args.files[i:i + 2] for i in range(0, len(args.files), 2)]
+	if args.manifest:
+		manifestPairs = readManifest(args.manifest)
+		if manifestPairs == None:
+			sys.exit(1)
+		pairs += manifestPairs
+	if len(pairs) == 0:
+		parser.error("no INPUT and OUTPUT files given")
+	if args.quality < 0 or args.quality > 1:
+		parser.error("quality must be a number from 0 to 1")
+	if args.bits != 16 and any([outputFile.lower().endswith('.sf3') for inputFile, outputFile in pairs]):
+		parser.error("SF3 files can only store 16 bit sample data")
+
+	if args.watch:
+		if len(pairs) != 1:
+			parser.error("watch mode requires a single INPUT and OUTPUT")
+		if statsOption:
+			parser.error("{} can not be used with --watch".format(statsOption))
+		if checkFormats(*pairs[0]) == None:
+			sys.exit(1)
+		try:
+			if not watch(args, *pairs[0]):
+				sys.exit(1)
+		except KeyboardInterrupt:
+			pass
+		return
+
+	if len(pairs) > 1 or args.manifest:
+		if statsOption:
+			parser.error("{} requires a single INPUT and OUTPUT".format(statsOption))
+		if not runBatch(args, pairs):
+			sys.exit(1)
+		return
+
+	inputFile, outputFile = pairs[0]
+	if checkFormats(inputFile, outputFile) == None:
 		sys.exit(1)
-elif outputFormat == 'sf2':
-	sf2 = SF2()
-	if not sf2.exportSF2(soundBank, outputFile):
+	cache = None
+	if args.cache:
+		cache = createCache(args.cache_dir, args.cache_size * 1024 * 1024)
+		if cache == None:
+			sys.exit(1)
+	stats = None
+	if args.stats or args.profile:
+		stats = Stats(args.profile)
+	# Progress messages are not mixed with a report on standard output
+	verbose = args.stats != '-'
+	result = convert(args, inputFile, outputFile, cache, verbose = verbose, stats = stats)
+	if args.stats:
+		stats.writeReport(args.stats)
+	if args.profile:
+		stats.writeProfile(args.profile_output or '{}.prof'.format(args.profile))
+	if not result:
 		sys.exit(1)
+	if verbose:
+		print("Done")
+
 
-print("Done")
+if __name__ == '__main__':
+	main()
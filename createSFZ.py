@@ -15,73 +15,251 @@
 import sys, logging
 logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(levelname)s: %(message)s')
 
-import re, os.path, time, textwrap
-from sfz import SFZ
-
-if len(sys.argv) < 2:
-	print("Usage:", sys.argv[0], "[SAMPLE]...\n", file=sys.stderr)
-	print(textwrap.dedent("""
-		Takes audio files as input and writes to stdout a SFZ template for them.
-		It tries to guess the pitch of each sample from its file name.
-
-		Examples:
-	""").strip(), file=sys.stderr)
-	print("")
-	print("    {}".format(sys.argv[0]), "samples/*.wav", file=sys.stderr)
-	print("    {}".format(sys.argv[0]), "piano_C4.wav piano_C5.wav piano_F#4.wav", file=sys.stderr)
-	sys.exit(0)
+import re, os, os.path, time, textwrap
+import concurrent.futures
+from sfz import SFZ, SFZParseError
+from wavinfo import readWavInfo
+from pitchdetect import detectPitch
 
-sfz = SFZ()
-regions = {}
+# Number of files whose sampler information is read at the same time
+probeThreads = 16
+
+# Detected pitches with lower confidence are not used
+minConfidence = 0.8
+
+# Velocity of layers named with a letter instead of a number
+velocityLetters = {'l': 42, 'm': 84, 'h': 127}
+
+# A number after a note number is a round robin only up to this, and when
+# it is lower than the note, as in piano_60_2.wav. Otherwise it is the note,
+# as in kick_1_60.wav.
+maxRoundRobin = 16
 
-noteRegEx = re.compile('^(.+[-_])?(([abcdefgABCDEFG])([b#]?)(-?[0-9]))(v(([0-9]{1,3})|[LMHlmh]))?([-_][0-9]+)?\.wav$')
-numRegEx = re.compile('^(.+[-_])?([0-9]{1,3})(v(([0-9]{1,3})|[LMHlmh]))?([-_][0-9]+)?\.wav')
+noteRegEx = re.compile(r'^(.+[-_])?(([abcdefgABCDEFG])([b#]?)(-?[0-9]))(v(([0-9]{1,3})|[LMHlmh]))?([-_][0-9]+)?\.wav$')
+numRegEx = re.compile(r'^(.+[-_])?([0-9]{1,3})(v(([0-9]{1,3})|[LMHlmh]))?([-_][0-9]+)?\.wav')
+numSuffixRegEx = re.compile(r'^(.+?[-_])?([0-9]{1,3})(v(([0-9]{1,3})|[LMHlmh]))?([-_][0-9]+)?\.wav')
 
-for fName in sys.argv[1:]:
+sfz = SFZ()
+
+def parseName(fName):
+	# Returns (noteNum, velocity, roundRobin) from the suffix of a file name.
+	# noteNum is None if it can not be guessed, velocity is 127 and roundRobin
+	# is 0 if not present.
 	match = noteRegEx.search(os.path.basename(fName))
 	if match:
-		noteNum = sfz.convertNote(match.group(2))
-		if noteNum == None:
-			logging.warning("Can't guess pitch from file name: {}".format(fName))
-			continue
-		regions[noteNum] = fName
-		continue
-	match = numRegEx.search(os.path.basename(fName))
-	if match:
+		try:
+			noteNum = sfz.convertNote(match.group(2))
+		except SFZParseError:
+			noteNum = None
+		velocity, roundRobin = match.group(7), match.group(9)
+	else:
+		match = numRegEx.search(os.path.basename(fName))
+		if not match:
+			return None, 127, 0
+		# The first number of the suffix is the note when it is followed by
+		# a velocity, or by a small round robin number
+		suffixMatch = numSuffixRegEx.search(os.path.basename(fName))
+		if suffixMatch.group(3) != None or (suffixMatch.group(6) != None and
+			int(suffixMatch.group(6)[1:]) <= min(maxRoundRobin, int(suffixMatch.group(2)) - 1)):
+			match = suffixMatch
 		noteNum = int(match.group(2))
 		if noteNum < 0 or noteNum > 127:
-			logging.warning("Can't guess pitch from file name: {}".format(fName))
+			noteNum = None
+		velocity, roundRobin = match.group(4), match.group(6)
+
+	if velocity == None:
+		velocity = 127
+	elif velocity.lower() in velocityLetters:
+		velocity = velocityLetters[velocity.lower()]
+	else:
+		velocity = min(int(velocity), 127)
+	if roundRobin == None:
+		roundRobin = 0
+	else:
+		roundRobin = int(roundRobin[1:])
+	return noteNum, velocity, roundRobin
+
+
+def scanDirectory(path):
+	# Yield WAV files found in path and its subdirectories
+	pending = [path]
+	while len(pending) > 0:
+		directory = pending.pop()
+		try:
+			entries = os.scandir(directory)
+		except OSError:
+			logging.warning("Can not read directory: {}".format(directory))
 			continue
-		regions[noteNum] = fName
-		continue
-	logging.warning("Can't guess pitch from file name: {}".format(fName))
-
-soundBank = {
-'Name': 'Unnamed sound bank',
-'Date': time.strftime("%Y-%m-%d"),
-'instruments': [{
-	'Instrument': 'Unnamed instrument',
-	'ampeg_release': '0.5',
-	'groups': [{
-		'loop_mode': 'no_loop',
-	    'regions': []
-    	}]
-	}]
-}
-
-prevRegion = None
-for noteNum in sorted(regions.keys()):
-	region = {}
-	region['sample'] = regions[noteNum]
-	region['pitch_keycenter'] = noteNum
-	if prevRegion:
-		gap = noteNum - prevRegion['pitch_keycenter'] - 1
-		leftGap = gap // 2
-		rightGap = gap - leftGap
-		prevRegion['hikey'] = prevRegion['pitch_keycenter'] + leftGap
-		region['lokey'] = noteNum - rightGap
-	soundBank['instruments'][0]['groups'][0]['regions'].append(region)
-	prevRegion = soundBank['instruments'][0]['groups'][0]['regions'][-1]
-
-sfz.soundBank = soundBank
-sfz.exportSFZ()
+		with entries:
+			for entry in entries:
+				if entry.is_dir():
+					pending.append(entry.path)
+				elif entry.name.lower().endswith('.wav'):
+					yield entry.path
+
+
+def createRegions(notes, wavInfo, tunes):
+	# Regions for a dict of MIDI notes and sample files, each one extending
+	# up to half the distance to the next one
+	regions = []
+	prevRegion = None
+	for noteNum in sorted(notes.keys()):
+		fName = notes[noteNum]
+		region = {}
+		region['sample'] = fName
+		region['pitch_keycenter'] = noteNum
+		if tunes.get(fName, 0) != 0:
+			region['tune'] = tunes[fName]
+		info = wavInfo[fName] or {}
+		if 'loops' in info:
+			loopType, loopStart, loopEnd = info['loops'][0]
+			if loopType != 0 or len(info['loops']) > 1:
+				logging.warning("Only the first loop is used, as a forward loop: {}".format(fName))
+			region['loop_mode'] = 'loop_continuous'
+			region['loop_start'] = loopStart
+			region['loop_end'] = loopEnd
+		if prevRegion:
+			gap = noteNum - prevRegion['pitch_keycenter'] - 1
+			leftGap = gap // 2
+			rightGap = gap - leftGap
+			prevRegion['hikey'] = prevRegion['pitch_keycenter'] + leftGap
+			region['lokey'] = noteNum - rightGap
+		regions.append(region)
+		prevRegion = region
+	return regions
+
+
+def main():
+	# Samples by velocity layer, MIDI note and round robin number
+	layers = {}
+	tunes = {}
+
+	if len(sys.argv) < 2:
+		print("Usage:", sys.argv[0], "[SAMPLE|DIRECTORY]...\n", file=sys.stderr)
+		print(textwrap.dedent("""
+			Takes audio files as input and writes to stdout a SFZ template for them.
+			It tries to guess the pitch of each sample from its file name, or else from
+			the sampler information of WAV files, which also provides loop points. The
+			pitch of any other sample is detected from its audio.
+
+			Directories are searched recursively for WAV files. Files of the same note
+			with velocity (v1 to v127, vL, vM, vH) or round robin (_1, _2...) suffixes
+			are placed in velocity layers and round robin groups.
+
+			Examples:
+		""").strip(), file=sys.stderr)
+		print("")
+		print("    {}".format(sys.argv[0]), "samples/*.wav", file=sys.stderr)
+		print("    {}".format(sys.argv[0]), "piano_C4.wav piano_C5.wav piano_F#4.wav", file=sys.stderr)
+		print("    {}".format(sys.argv[0]), "samples/", file=sys.stderr)
+		sys.exit(0)
+
+	fileNames = []
+	for arg in sys.argv[1:]:
+		if os.path.isdir(arg):
+			fileNames.extend(sorted(scanDirectory(arg)))
+		else:
+			fileNames.append(arg)
+
+	# Only headers and sampler chunks are read, many files at once, since they may
+	# be stored on slow or network disks
+	with concurrent.futures.ThreadPoolExecutor(probeThreads) as pool:
+		wavInfo = dict(zip(fileNames, pool.map(readWavInfo, fileNames)))
+
+	def addSample(fName, noteNum, velocity, roundRobin):
+		notes = layers.setdefault(velocity, {})
+		samples = notes.setdefault(noteNum, {})
+		if roundRobin in samples:
+			logging.warning("Sample {} replaced by {}".format(samples[roundRobin], fName))
+		samples[roundRobin] = fName
+
+	unknown = []
+	for fName in fileNames:
+		info = wavInfo[fName] or {}
+		noteNum, velocity, roundRobin = parseName(fName)
+		if noteNum == None:
+			noteNum = info.get('pitch')
+			if noteNum == None:
+				unknown.append(fName)
+				continue
+		elif 'pitch' in info and info['pitch'] != noteNum:
+			logging.warning("File name and sampler information have different pitch, using {}: {}".format(
+				noteNum, fName))
+		addSample(fName, noteNum, velocity, roundRobin)
+
+	# Pitch of the remaining samples is detected from their audio, using all
+	# processors. Samples with doubtful results are left out.
+	if len(unknown) > 0:
+		with concurrent.futures.ProcessPoolExecutor() as pool:
+			detected = list(pool.map(detectPitch, unknown, chunksize = 8))
+		for fName, pitch in zip(unknown, detected):
+			if pitch == None:
+				logging.warning("Can't guess pitch: {}".format(fName))
+				continue
+			noteNum, cents, confidence = pitch
+			if confidence < minConfidence:
+				logging.warning("Detected pitch {} has low confidence ({:.2f}), sample not used: {}".format(
+					noteNum, confidence, fName))
+				continue
+			logging.info("Detected pitch {} {:+.0f} cents (confidence {:.2f}): {}".format(
+				noteNum, cents, confidence, fName))
+			addSample(fName, noteNum, 127, 0)
+			tunes[fName] = -int(round(cents))
+
+	soundBank = {
+	'Name': 'Unnamed sound bank',
+	'Date': time.strftime("%Y-%m-%d"),
+	'instruments': [{
+		'Instrument': 'Unnamed instrument',
+		'ampeg_release': '0.5',
+		'groups': []
+		}]
+	}
+
+	# A group for each velocity layer and round robin position. Each layer
+	# covers velocities from the one above the previous layer up to its own.
+	# Every layer and position has all the notes, so that key ranges are the
+	# same in all of them: notes missing from a layer are taken from the
+	# nearest one, and positions beyond the number of takes of a note cycle
+	# through them.
+	lovel = 0
+	velocities = sorted(layers.keys())
+	allNotes = set()
+	for notes in layers.values():
+		allNotes.update(notes.keys())
+	for velocity in velocities:
+		notes = dict(layers[velocity])
+		for noteNum in allNotes - set(notes.keys()):
+			nearest = min([v for v in velocities if noteNum in layers[v]],
+				key = lambda v: (abs(v - velocity), -v))
+			notes[noteNum] = layers[nearest][noteNum]
+		hivel = velocity
+		if velocity == velocities[-1]:
+			hivel = 127
+		seqLength = max(len(samples) for samples in notes.values())
+		for position in range(0, seqLength):
+			group = {'loop_mode': 'no_loop'}
+			if lovel > 0:
+				group['lovel'] = lovel
+			if hivel < 127:
+				group['hivel'] = hivel
+			if seqLength > 1:
+				group['seq_length'] = seqLength
+				group['seq_position'] = position + 1
+			groupNotes = {}
+			for noteNum, samples in notes.items():
+				roundRobins = sorted(samples.keys())
+				groupNotes[noteNum] = samples[roundRobins[position % len(roundRobins)]]
+			group['regions'] = createRegions(groupNotes, wavInfo, tunes)
+			soundBank['instruments'][0]['groups'].append(group)
+		lovel = hivel + 1
+
+	if len(soundBank['instruments'][0]['groups']) == 0:
+		soundBank['instruments'][0]['groups'].append({'loop_mode': 'no_loop', 'regions': []})
+
+	sfz.soundBank = soundBank
+	sfz.exportSFZ()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+#
+# Copyright 2016, roberto@zenvoid.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# Supported SFZ opcodes. Each one has a value type:
+#
+#   path: file name of an audio sample
+#   note: MIDI note number or note name
+#   int, float: number between min and max
+#   enum: one of the strings in values
+#
+# Opcodes which set other opcodes list them in sets. Opcodes which can be
+# converted to a SF2 generator include its name in sf2Gen, and the SF2 method
+# which converts the value in sf2Value, and in sf2Requires the values which
+# other opcodes must have, if set, for the generator to have the same meaning.
+# Generators are created in the order in which they appear here.
+
+sfzOpcodes = {
+	'sample': {'type': 'path'},
+	'lokey': {'type': 'note'},
+	'hikey': {'type': 'note'},
+	'pitch_keycenter': {'type': 'note'},
+	'key': {'type': 'note', 'sets': ['hikey', 'lokey', 'pitch_keycenter']},
+	'lovel': {'type': 'int', 'min': -1, 'max': 127},
+	'hivel': {'type': 'int', 'min': -1, 'max': 127},
+	'delay': {'type': 'float', 'min': 0, 'max': 100,
+		'sf2Gen': 'delayVolEnv', 'sf2Value': 'genTime'},
+	'ampeg_attack': {'type': 'float', 'min': 0, 'max': 100,
+		'sf2Gen': 'attackVolEnv', 'sf2Value': 'genTime'},
+	'ampeg_decay': {'type': 'float', 'min': 0, 'max': 100,
+		'sf2Gen': 'decayVolEnv', 'sf2Value': 'genTime'},
+	'ampeg_sustain': {'type': 'float', 'min': 0, 'max': 100,
+		'sf2Gen': 'sustainVolEnv', 'sf2Value': 'genSustain'},
+	'ampeg_hold': {'type': 'float', 'min': 0, 'max': 100,
+		'sf2Gen': 'holdVolEnv', 'sf2Value': 'genTime'},
+	'ampeg_release': {'type': 'float', 'min': 0, 'max': 100,
+		'sf2Gen': 'releaseVolEnv', 'sf2Value': 'genTime'},
+	'cutoff': {'type': 'float', 'min': 0, 'max': 2822400,
+		'sf2Gen': 'initialFilterFc', 'sf2Value': 'freqToAbsoluteCents',
+		'sf2Requires': {'fil_type': ['lpf_2p']}},
+	'resonance': {'type': 'float', 'min': 0, 'max': 40,
+		'sf2Gen': 'initialFilterQ', 'sf2Value': 'genFilterQ'},
+	'volume': {'type': 'float', 'min': -144, 'max': 6,
+		'sf2Gen': 'initialAttenuation', 'sf2Value': 'genAttenuation'},
+	'tune': {'type': 'int', 'min': -100, 'max': 100,
+		'sf2Gen': 'fineTune', 'sf2Value': 'genInteger'},
+	'pitch_keytrack': {'type': 'int', 'min': -1200, 'max': 1200,
+		'sf2Gen': 'scaleTuning', 'sf2Value': 'genInteger'},
+	'loop_start': {'type': 'int', 'min': 0, 'max': 4294967296},
+	'loop_end': {'type': 'int', 'min': 0, 'max': 4294967296},
+	'loop_mode': {'type': 'enum',
+		'values': ['no_loop', 'one_shot', 'loop_continuous', 'loop_sustain']},
+	'fil_type': {'type': 'enum',
+		'values': ['lpf_1p', 'hpf_1p', 'lpf_2p', 'hpf_2p', 'bpf_2p', 'brf_2p']},
+	'lorand': {'type': 'float', 'min': 0, 'max': 1},
+	'hirand': {'type': 'float', 'min': 0, 'max': 1},
+	'pan': {'type': 'float', 'min': -100, 'max': 100},
+	'seq_length': {'type': 'int', 'min': 1, 'max': 100},
+	'seq_position': {'type': 'int', 'min': 1, 'max': 100},
+	'amp_veltrack': {'type': 'float', 'min': -100, 'max': 100}
+}
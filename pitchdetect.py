@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+#
+# Copyright 2016, roberto@zenvoid.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# Detection of the pitch of audio samples with the YIN algorithm (de Cheveigné
+# and Kawahara, 2002). The difference function is computed for all lags at
+# once from an FFT based autocorrelation. Only a short window of each sample is
+# read, after the attack.
+
+import math, logging
+import soundfile
+import numpy
+
+# Frames analyzed, and lowest and highest frequencies which can be detected
+windowSize = 8192
+minFrequency = 27.5
+maxFrequency = 4200
+
+# A dip of the normalized difference function below this value is a period
+yinThreshold = 0.15
+
+
+def detectPitch(fileName):
+	# Returns (noteNum, cents, confidence), where cents is the deviation of
+	# the sample from noteNum and confidence goes from 0 to 1, or None if the
+	# file can not be read or no pitch is found
+	try:
+		info = soundfile.info(fileName)
+		start = max(0, min(info.frames // 4, info.frames - windowSize))
+		data, rate = soundfile.read(fileName, frames = windowSize, start = start, dtype = 'float64',
+			always_2d = True)
+	except Exception:
+		logging.error("Can not read input audio file {}".format(fileName))
+		return None
+
+	signal = data.mean(axis = 1)
+	signal -= signal.mean()
+	maxLag = min(int(rate / minFrequency), len(signal) // 2)
+	minLag = max(2, int(rate / maxFrequency))
+	if maxLag <= minLag + 2 or not numpy.any(signal):
+		return None
+
+	# Difference function d(tau) = r(0) + r_tau(0) - 2 r(tau), over a
+	# window of the length of the signal minus the longest lag
+	length = len(signal) - maxLag
+	fftSize = 1 << (len(signal) + length).bit_length()
+	spectrum = numpy.fft.rfft(signal, fftSize)
+	kernel = numpy.fft.rfft(signal[length - 1::-1], fftSize)
+	correlation = numpy.fft.irfft(spectrum * kernel, fftSize)[length - 1:length + maxLag]
+	energy = numpy.concatenate(([0.0], numpy.cumsum(signal ** 2)))
+	energies = energy[length:length + maxLag + 1] - energy[0:maxLag + 1]
+	difference = energies[0] + energies - 2 * correlation
+
+	# Cumulative mean normalized difference
+	difference[0] = 0
+	cumulative = numpy.cumsum(difference[1:])
+	normalized = numpy.ones(maxLag + 1)
+	normalized[1:] = difference[1:] * numpy.arange(1, maxLag + 1) / numpy.where(cumulative > 0, cumulative, 1)
+
+	# First dip below the threshold, or else the global minimum
+	candidates = numpy.nonzero(normalized[minLag:maxLag] < yinThreshold)[0]
+	if len(candidates) > 0:
+		lag = minLag + candidates[0]
+		while lag + 1 < maxLag and normalized[lag + 1] < normalized[lag]:
+			lag += 1
+	else:
+		lag = minLag + int(numpy.argmin(normalized[minLag:maxLag]))
+	confidence = max(0.0, 1.0 - float(normalized[lag]))
+
+	# Parabolic interpolation of the minimum
+	period = float(lag)
+	if 0 < lag < maxLag:
+		a, b, c = normalized[lag - 1], normalized[lag], normalized[lag + 1]
+		if a + c - 2 * b > 0:
+			period += (a - c) / (2 * (a + c - 2 * b))
+
+	note = 69 + 12 * math.log2(rate / period / 440)
+	noteNum = int(round(note))
+	if noteNum < 0 or noteNum > 127:
+		return None
+	return noteNum, (note - noteNum) * 100, confidence
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+#
+# Copyright 2016, roberto@zenvoid.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# Analysis of decoded audio samples before they are stored: silence at both
+# ends of a sample, and loop points of sustained sounds. Sample data is given
+# as an array of frames by channels.
+#
+# Loop points are searched at rising zero crossings. The sound around a few
+# candidate loop ends is compared with the sound around every candidate loop
+# start at once, by normalized cross-correlation computed with FFTs.
+
+import numpy
+
+# Length of the sound compared at each side of loop points, in seconds
+loopWindow = 0.01
+
+# Shortest loop, in seconds
+minLoopLength = 0.1
+
+# Loops start after this fraction of the sound, to skip the attack, and end
+# at one of the candidates spread over the range given by the next two
+loopStartFraction = 0.25
+loopEndFractions = (0.6, 0.9)
+loopEndCandidates = 4
+
+# Lowest correlation of the sound around both loop points which is accepted
+minLoopScore = 0.9
+
+
+def findSound(data, threshold):
+	# Returns (start, end) of the frames between the first and the last one
+	# louder than threshold (in dB below full scale), or the whole sample if
+	# it is all silent
+	level = numpy.iinfo(data.dtype).max * 10 ** (threshold / 20)
+	loud = numpy.nonzero(numpy.abs(data).max(axis = 1) > level)[0]
+	if len(loud) == 0:
+		return 0, len(data)
+	return int(loud[0]), int(loud[-1]) + 1
+
+
+def findLoop(data, rate):
+	# Returns (start, end) of the best loop found, with end excluded, or
+	# None if no good loop is found
+	signal = data.mean(axis = 1, dtype = 'float64')
+	frames = len(signal)
+	window = max(64, int(rate * loopWindow))
+	minLength = int(rate * minLoopLength)
+	crossings = numpy.nonzero((signal[:-1] < 0) & (signal[1:] >= 0))[0] + 1
+	crossings = crossings[(crossings >= window) & (crossings <= frames - window)]
+	if len(crossings) < 2:
+		return None
+
+	first = max(window, int(frames * loopStartFraction))
+	best = None
+	bestScore = minLoopScore
+	for fraction in numpy.linspace(loopEndFractions[0], loopEndFractions[1], loopEndCandidates):
+		# Rising zero crossing closest to the candidate loop end
+		end = int(crossings[numpy.argmin(numpy.abs(crossings - frames * fraction))])
+		last = end - minLength
+		starts = crossings[(crossings >= first) & (crossings <= last)]
+		if len(starts) == 0:
+			continue
+
+		# Correlation of the sound around the loop end with the sound around
+		# each frame from first to last
+		reference = signal[end - window:end + window]
+		segment = signal[first - window:last + window]
+		fftSize = 1 << (len(segment) + len(reference)).bit_length()
+		correlation = numpy.fft.irfft(numpy.fft.rfft(segment, fftSize) *
+			numpy.conj(numpy.fft.rfft(reference, fftSize)), fftSize)[0:last - first + 1]
+		energy = numpy.concatenate(([0.0], numpy.cumsum(segment ** 2)))
+		energies = energy[2 * window:] - energy[:-2 * window]
+		norm = numpy.sqrt(energies * numpy.dot(reference, reference))
+		scores = correlation / numpy.where(norm > 0, norm, numpy.inf)
+
+		candidate = int(numpy.argmax(scores[starts - first]))
+		if scores[starts[candidate] - first] > bestScore:
+			bestScore = scores[starts[candidate] - first]
+			best = (int(starts[candidate]), end)
+	return best
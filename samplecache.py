@@ -0,0 +1,275 @@
+#!/usr/bin/python3
+#
+# Copyright 2016, roberto@zenvoid.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# On-disk cache of decoded audio samples, converted to the PCM format used in
+# sound bank files. Each entry is a file containing a small header followed by
+# the data of each channel, one after the other:
+#
+#   magic (4 bytes), sample rate, channels, frames (unsigned 32 bits each)
+#
+# Entries are identified by the absolute path of the audio file, its size, its
+# modification time and the requested format, so a modified file is never
+# read from the cache. Hits are read through mmap without copying the data.
+
+import os, struct, hashlib, mmap, logging, threading, collections, time
+
+
+class SampleCache:
+
+	magic = b'FPSC'
+	headerFormat = '<4sIII'
+	headerSize = struct.calcsize(headerFormat)
+
+	# Entries being written by any process are temporary files, which are
+	# only removed when they are older than this (in seconds), since they are
+	# then left over by an interrupted process
+	staleAge = 24 * 3600
+
+	def __init__(self, path = None, maxSize = 2048 * 1024 * 1024):
+		if path == None:
+			cacheHome = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+			path = os.path.join(cacheHome, 'freepats-tools', 'samples')
+		self.path = path
+		self.maxSize = maxSize
+		os.makedirs(self.path, exist_ok = True)
+
+
+	def entryName(self, samplePath, sampleFormat):
+		try:
+			stat = os.stat(samplePath)
+		except OSError:
+			return None
+		key = '{}\0{}\0{}\0{}'.format(os.path.abspath(samplePath), stat.st_size,
+			stat.st_mtime_ns, sampleFormat)
+		return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+	def get(self, samplePath, sampleFormat, sampleWidth):
+		# Returns (rate, channels, channelData), where channelData holds a
+		# memoryview of the mapped file for each channel, or None if the
+		# sample is not cached
+		entry = self.entryName(samplePath, sampleFormat)
+		if entry == None:
+			return None
+		try:
+			with open(entry, 'rb') as entryFile:
+				data = mmap.mmap(entryFile.fileno(), 0, access = mmap.ACCESS_READ)
+		except (OSError, ValueError):
+			return None
+
+		if len(data) < SampleCache.headerSize:
+			data.close()
+			return None
+		magic, rate, channels, frames = struct.unpack_from(SampleCache.headerFormat, data)
+		channelSize = frames * sampleWidth
+		if magic != SampleCache.magic \
+		or len(data) != SampleCache.headerSize + channels * channelSize:
+			data.close()
+			return None
+
+		# Touch the entry, so that it is the last one to be evicted
+		try:
+			os.utime(entry)
+		except OSError:
+			pass
+
+		view = memoryview(data)
+		channelData = []
+		for ch in range(0, channels):
+			start = SampleCache.headerSize + ch * channelSize
+			channelData.append(view[start:start + channelSize])
+		return rate, channels, channelData
+
+
+	def create(self, samplePath, sampleFormat, rate, channels, frames):
+		entry = self.entryName(samplePath, sampleFormat)
+		if entry == None:
+			return None
+		try:
+			return SampleCacheWriter(entry, rate, channels, frames)
+		except OSError:
+			logging.warning("Can not store sample in cache: {}".format(entry))
+			return None
+
+
+	def trim(self):
+		# Evict least recently used entries until the cache fits in maxSize
+		entries = []
+		totalSize = 0
+		now = time.time()
+		for dirEntry in os.scandir(self.path):
+			try:
+				stat = dirEntry.stat()
+			except OSError:
+				continue
+			if '.tmp' in dirEntry.name:
+				if now - stat.st_mtime > SampleCache.staleAge:
+					try:
+						os.unlink(dirEntry.path)
+					except OSError:
+						pass
+				continue
+			entries.append((stat.st_mtime_ns, stat.st_size, dirEntry.path))
+			totalSize += stat.st_size
+
+		entries.sort()
+		for mtime, size, path in entries:
+			if totalSize <= self.maxSize:
+				break
+			try:
+				os.unlink(path)
+			except OSError:
+				continue
+			totalSize -= size
+
+
+class ReadOnlySampleCache:
+
+	# Reads the entries of another cache, without adding or removing any
+
+	def __init__(self, cache):
+		self.cache = cache
+
+
+	def get(self, samplePath, sampleFormat, sampleWidth):
+		return self.cache.get(samplePath, sampleFormat, sampleWidth)
+
+
+	def create(self, samplePath, sampleFormat, rate, channels, frames):
+		return None
+
+
+	def trim(self):
+		pass
+
+
+class SampleCacheWriter:
+
+	def __init__(self, entry, rate, channels, frames):
+		self.entry = entry
+		self.tmpName = '{}.tmp{}-{}'.format(entry, os.getpid(), threading.get_ident())
+		self.outFile = open(self.tmpName, 'wb')
+		self.outFile.write(struct.pack(SampleCache.headerFormat, SampleCache.magic,
+			rate, channels, frames))
+
+
+	def write(self, data):
+		self.outFile.write(data)
+
+
+	def commit(self):
+		self.outFile.close()
+		try:
+			os.replace(self.tmpName, self.entry)
+		except OSError:
+			logging.warning("Can not store sample in cache: {}".format(self.entry))
+			self.abort()
+
+
+	def abort(self):
+		self.outFile.close()
+		try:
+			os.unlink(self.tmpName)
+		except OSError:
+			pass
+
+
+class MemorySampleCache:
+
+	# Same interface as SampleCache, keeping decoded samples in memory. Used
+	# by long running processes which convert the same samples many times.
+	# Entries which have not been used since the previous call to trim are
+	# removed by it, as well as the least recently used ones when the cache
+	# grows over maxSize.
+
+	def __init__(self, maxSize = 2048 * 1024 * 1024):
+		self.maxSize = maxSize
+		self.entries = collections.OrderedDict()
+		self.used = set()
+		self.lock = threading.Lock()
+
+
+	def entryKey(self, samplePath, sampleFormat):
+		try:
+			stat = os.stat(samplePath)
+		except OSError:
+			return None
+		return (os.path.abspath(samplePath), stat.st_size, stat.st_mtime_ns, sampleFormat)
+
+
+	def get(self, samplePath, sampleFormat, sampleWidth):
+		key = self.entryKey(samplePath, sampleFormat)
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry == None:
+				return None
+			self.entries.move_to_end(key)
+			self.used.add(key)
+		rate, channels, channelData = entry
+		return rate, channels, [memoryview(data) for data in channelData]
+
+
+	def create(self, samplePath, sampleFormat, rate, channels, frames):
+		key = self.entryKey(samplePath, sampleFormat)
+		if key == None:
+			return None
+		return MemorySampleCacheWriter(self, key, rate, channels)
+
+
+	def store(self, key, entry):
+		with self.lock:
+			self.entries[key] = entry
+			self.entries.move_to_end(key)
+			self.used.add(key)
+
+
+	def size(self):
+		return sum(len(data) for rate, channels, channelData in self.entries.values() for data in channelData)
+
+
+	def trim(self):
+		with self.lock:
+			for key in list(self.entries.keys()):
+				if not key in self.used:
+					del self.entries[key]
+			self.used = set()
+			totalSize = self.size()
+			while totalSize > self.maxSize and len(self.entries) > 0:
+				key, (rate, channels, channelData) = self.entries.popitem(last = False)
+				totalSize -= sum(len(data) for data in channelData)
+
+
+class MemorySampleCacheWriter:
+
+	def __init__(self, cache, key, rate, channels):
+		self.cache = cache
+		self.key = key
+		self.rate = rate
+		self.channels = channels
+		self.data = bytearray()
+
+
+	def write(self, data):
+		self.data += data
+
+
+	def commit(self):
+		channelSize = len(self.data) // self.channels
+		channelData = [bytes(self.data[ch * channelSize:(ch + 1) * channelSize]) for ch in range(0, self.channels)]
+		self.data = None
+		self.cache.store(self.key, (self.rate, self.channels, channelData))
+
+
+	def abort(self):
+		self.data = None
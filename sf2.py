@@ -17,18 +17,78 @@
 # to convert from XML descriptions to SoundFont files:
 # https://github.com/freepats/tools
 
-import struct, logging, os, math, sys
+import struct, logging, os, math, sys, re, collections, mmap, io, hashlib, types, tempfile, shutil, zlib
+import json
+import concurrent.futures
 import dateutil.parser
 import soundfile
+import numpy
+from opcodes import sfzOpcodes
+from compactbank import CompactRegions, ResolvedRegions
+from stats import statsPhase
+from sampleanalysis import findSound, findLoop
 
 
 class SF2ExportError(Exception):
 	pass
 
 
+class SF2ImportError(Exception):
+	pass
+
+
+def encodeVorbis(blocks, rate, quality):
+	# Encode a channel of 16 bit sample data as an Ogg Vorbis stream. It is
+	# a module function so that it can be run by a pool of processes.
+	outData = io.BytesIO()
+	with soundfile.SoundFile(outData, 'w', rate, 1, 'VORBIS', format = 'OGG',
+		compression_level = 1 - quality) as outFile:
+		for block in blocks:
+			outFile.write(numpy.frombuffer(block, dtype = '<i2'))
+	return setOggSerial(outData.getbuffer(), 0)
+
+
+# Bytes with the order of their bits reversed
+reversedBits = bytes([int('{:08b}'.format(i)[::-1], 2) for i in range(0, 256)])
+
+def setOggSerial(data, serial):
+	# libsndfile gives a random serial number to each Ogg stream, which is
+	# replaced so that the same file is written every time. The checksum of
+	# each page is the CRC-32 of the page with non reflected bits, computed
+	# with zlib from the reflected CRC of its bytes with their bits reversed.
+	data = bytearray(data)
+	pos = 0
+	while pos + 27 <= len(data) and data[pos:pos + 4] == b'OggS':
+		segments = data[pos + 26]
+		end = pos + 27 + segments + sum(data[pos + 27:pos + 27 + segments])
+		struct.pack_into('<I', data, pos + 14, serial)
+		struct.pack_into('<I', data, pos + 22, 0)
+		crc = zlib.crc32(bytes(data[pos:end]).translate(reversedBits), 0xffffffff) ^ 0xffffffff
+		struct.pack_into('<I', data, pos + 22, int('{:032b}'.format(crc)[::-1], 2))
+		pos = end
+	return bytes(data)
+
+
 class SF2:
 
+	# Number of frames read at once from each sample in streaming mode
+	sfBlockSize = 65536
+
+	# Statistics of each phase are recorded here if set (see stats.py)
+	stats = None
+
+	# Suffix of the file which lists the audio files used by an output file
+	# written in incremental mode, with their size and modification time
+	sfStateSuffix = '.samples'
+
+	# Type in which audio samples are decoded, and type of the decoded data,
+	# for each sample size. 24 bit samples are decoded to 32 bit integers,
+	# whose upper bytes go to the smpl chunk and the next one to sm24.
+	sfSampleFormats = {16: ('int16', '<i2'), 24: ('int32', '<i4')}
+
 	sfGenId = {
+		'startloopAddrsOffset': 2,
+		'endloopAddrsOffset': 3,
 		'initialFilterFc': 8,
 		'initialFilterQ': 9,
 		'pan': 17,
@@ -41,8 +101,10 @@ class SF2:
 		'instrument': 41,
 		'keyRange': 43,
 		'velRange': 44,
+		'startloopAddrsCoarseOffset': 45,
 		'velocity': 47,
 		'initialAttenuation': 48,
+		'endloopAddrsCoarseOffset': 50,
 		'fineTune': 52,
 		'sampleID': 53,
 		'sampleModes': 54,
@@ -50,6 +112,9 @@ class SF2:
 		'overridingRootKey': 58
 	}
 
+	# Opcodes converted to generators by createGenList
+	genOpcodes = [opcode for opcode in sfzOpcodes.keys() if 'sf2Gen' in sfzOpcodes[opcode]]
+
 	sfGenType = {
 		'delayVolEnv': 'h',
 		'attackVolEnv': 'h',
@@ -64,43 +129,136 @@ class SF2:
 		'scaleTuning': 'h'
 	}
 
-	def exportSF2(self, soundBank, fileName):
-		self.soundBank = soundBank
-		self.nextProgram = 0
+	# Records of the pdta sub-chunks
+	sfPhdrRecord = numpy.dtype([('name', 'S20'), ('preset', '<u2'), ('bank', '<u2'),
+		('bagNdx', '<u2'), ('library', '<u4'), ('genre', '<u4'), ('morphology', '<u4')])
+	sfInstRecord = numpy.dtype([('name', 'S20'), ('bagNdx', '<u2')])
+	sfBagRecord = numpy.dtype([('genNdx', '<u2'), ('modNdx', '<u2')])
+	sfGenRecord = numpy.dtype([('oper', '<u2'), ('amount', '<u2')])
+	sfModRecord = numpy.dtype([('srcOper', '<u2'), ('destOper', '<u2'), ('amount', '<i2'),
+		('amtSrcOper', '<u2'), ('transOper', '<u2')])
+	sfShdrRecord = numpy.dtype([('name', 'S20'), ('start', '<u4'), ('end', '<u4'),
+		('loopStart', '<u4'), ('loopEnd', '<u4'), ('rate', '<u4'), ('pitch', 'u1'),
+		('correction', 'i1'), ('link', '<u2'), ('type', '<u2')])
+
+	def exportSF2(self, soundBank, fileName, stream = False, jobs = 1, cache = None, incremental = False,
+		dedup = False, bits = 16, quality = None, trimSilence = None, findLoops = False):
+		self.initExport(soundBank, stream, jobs, cache, dedup, bits, quality, trimSilence, findLoops)
+		self.incremental = incremental
+		# The list of audio files of the previous output is removed before it
+		# is replaced, so that it never describes another file
+		stateName = fileName + SF2.sfStateSuffix
+		self.previousStates = None
+		if incremental:
+			self.previousStates = self.readStates(stateName)
 		try:
-			self.outFile = open(fileName, 'wb')
+			os.unlink(stateName)
+		except FileNotFoundError:
+			pass
+		except OSError:
+			logging.error("Can not remove file {}".format(stateName))
+			return False
+		outName = fileName
+		if incremental and os.path.exists(fileName):
+			# Sample data may be copied from the previous file, so the new
+			# one is written aside and renamed when finished
+			try:
+				self.previousFile = open(fileName, 'rb')
+				outName = fileName + '.tmp'
+			except:
+				logging.warning("Can not read previous file {}".format(fileName))
+		try:
+			self.outFile = open(outName, 'wb')
 		except:
-			logging.error("Can not create file {}".format(fileName))
+			logging.error("Can not create file {}".format(outName))
+			self.closePreviousFile()
 			return False
 
+		def sfPdta():
+			with statsPhase(self.stats, 'sfPdta'):
+				return self.sfPdta()
+
 		try:
+			# sfPdta is called lazily, since shdr offsets are not known until
+			# sample data has been written in streaming mode
+			with statsPhase(self.stats, 'sfSdta'):
+				sdta = self.sfSdta()
 			sf2 = [[[b'RIFF', b'sfbk'], [
 				self.sfInfo(),
-				self.sfSdta(),
-				self.sfPdta()
+				sdta,
+				sfPdta
 			]]]
 
-			self.exportChunks(sf2)
+			with statsPhase(self.stats, 'exportChunks'):
+				self.exportChunks(sf2)
+			if self.stats:
+				self.stats.count('exportChunks', 'bytes', self.outFile.tell())
 		except SF2ExportError:
 			self.outFile.close()
-			os.unlink(fileName)
+			os.unlink(outName)
+			self.closePreviousFile()
 			logging.error("Failed to export SF2 to file {}".format(fileName))
 			return False
 		except:
 			self.outFile.close()
-			os.unlink(fileName)
+			os.unlink(outName)
+			self.closePreviousFile()
 			logging.error("Failed to export SF2 to file {}".format(fileName))
 			raise
 
 		self.outFile.close()
 		self.outFile = None
+		self.closePreviousFile()
+		if outName != fileName:
+			os.replace(outName, fileName)
+		if incremental and self.sampleStates != None:
+			self.writeStates(stateName, self.sampleStates)
 		self.sampleList = {}
-		self.shdrData = bytearray()
+		self.shdrRecords = []
+		if self.cache:
+			self.cache.trim()
 		return True
 
 
+	def initExport(self, soundBank, stream = False, jobs = 1, cache = None, dedup = False, bits = 16,
+		quality = None, trimSilence = None, findLoops = False):
+		# Set up the state used by the chunk methods (sfInfo, sfSdta, sfPdta),
+		# which can then be called one by one. If quality is given (from 0 to
+		# 1), a SF3 file is written, with Ogg Vorbis compressed sample data.
+		# Silence below trimSilence (in dB) is removed from both ends of each
+		# sample, and with findLoops, loop points are searched for looped
+		# samples without them (see sampleanalysis.py).
+		if not bits in SF2.sfSampleFormats.keys():
+			raise ValueError("Unsupported sample size: {}".format(bits))
+		if quality != None and bits != 16:
+			raise ValueError("SF3 sample data must be 16 bit")
+		self.soundBank = soundBank
+		self.nextProgram = 0
+		self.stream = stream
+		self.jobs = jobs
+		self.cache = cache
+		self.dedup = dedup
+		self.incremental = False
+		self.zoneErrors = None
+		self.bits = bits
+		self.quality = quality
+		self.trimSilence = trimSilence
+		self.findLoops = findLoops
+		self.previousFile = None
+		self.previousSmpl = None
+		self.resolveOpcodes()
+
+
+	def closePreviousFile(self):
+		if self.previousFile:
+			self.previousFile.close()
+			self.previousFile = None
+
+
 	def exportChunks(self, chunks):
 		for chunk in chunks:
+			if callable(chunk):
+				chunk = chunk()
 			(key, data) = chunk
 			form = None
 			if type(key) == list:
@@ -113,6 +271,8 @@ class SF2:
 
 			if type(data) == list:
 				self.exportChunks(data)
+			elif callable(data):
+				data()
 			else:
 				self.outFile.write(data)
 
@@ -123,6 +283,37 @@ class SF2:
 			self.outFile.seek(dataEnd)
 
 
+	def resolveOpcodes(self):
+		# Flatten the opcodes inherited by each region, once per export.
+		# Every region gets two read only views: one with the values of its
+		# instrument, group and region, and another one with only its group and
+		# region values, used for zone generators which must not repeat those
+		# already set in the instrument global zone. Views are stored by group,
+		# in the order of its regions, since regions may be created on access.
+		# Views of CompactRegions are also created on access, over a single
+		# dict of inherited opcodes for the group (see compactbank).
+		self.regionOpcodes = {}
+		for instrument in self.soundBank['instruments']:
+			instOpcodes = {k: v for k, v in instrument.items() if k != 'groups'}
+			for group in instrument['groups']:
+				groupOpcodes = {k: v for k, v in group.items() if k != 'regions'}
+				if isinstance(group['regions'], CompactRegions):
+					opcodes = dict(instOpcodes)
+					opcodes.update(groupOpcodes)
+					self.regionOpcodes[id(group)] = ResolvedRegions(group['regions'],
+						types.MappingProxyType(opcodes), types.MappingProxyType(groupOpcodes))
+					continue
+				regionOpcodes = []
+				for region in group['regions']:
+					localOpcodes = dict(groupOpcodes)
+					localOpcodes.update(region)
+					opcodes = dict(instOpcodes)
+					opcodes.update(localOpcodes)
+					regionOpcodes.append((types.MappingProxyType(opcodes),
+						types.MappingProxyType(localOpcodes)))
+				self.regionOpcodes[id(group)] = regionOpcodes
+
+
 	def getOpcode(self, opcode, instrument = None, group = None, region = None, default = None):
 		if region and opcode in region.keys():
 			return region[opcode]
@@ -167,6 +358,28 @@ class SF2:
 		return value
 
 
+	def genSustain(self, percent):
+		percent = float(percent)
+		if percent == 0:
+			return 1000
+		return min(self.percentToCentibels(percent), 1000)
+
+
+	def genFilterQ(self, value):
+		return int(float(value) * 10)
+
+
+	def genAttenuation(self, volume):
+		volume = float(volume)
+		if volume > 0:
+			logging.warning("SF2 format does not support amplification (positive volume value)")
+		return int(-volume * 10)
+
+
+	def genInteger(self, value):
+		return int(value)
+
+
 	def genTime(self, seconds):
 		if seconds == 0:
 			return -32768
@@ -181,6 +394,11 @@ class SF2:
 	def sfInfo(self):
 		sfMajor = 2
 		sfMinor = 1
+		if self.bits == 24:
+			# The sm24 chunk was introduced in version 2.04
+			sfMinor = 4
+		if self.quality != None:
+			sfMajor = 3
 		name = 'Sound Bank'
 		comments = ''
 
@@ -202,125 +420,743 @@ class SF2:
 
 
 	def sfSdta(self):
-		sampleIndex = 0
 		self.sampleList = {}
-		self.shdrData = bytearray()
-		smplData = bytearray()
+		self.shdrRecords = []
+		samples = self.collectSamples()
+		self.sampleStates = None
+		if self.incremental and self.reusableSdta():
+			# Files are checked before being read, so that a file modified
+			# meanwhile is never taken as unchanged
+			self.sampleStates = self.fileStates(samples)
+
+		if self.previousFile and self.sampleStates != None:
+			layout = self.checkPreviousSdta(samples)
+			if layout:
+				logging.info("Reusing sample data from previous file")
+				self.sfShdrLayout(samples, layout)
+				return [[b'LIST', b'sdta'], [
+					[b'smpl', self.copyPreviousSmpl]
+				]]
+
+		if self.quality != None:
+			if self.stream:
+				return [[b'LIST', b'sdta'], [
+					[b'smpl', lambda: self.sfSmplVorbis(samples, self.outFile)]
+				]]
+			smplData = io.BytesIO()
+			self.sfSmplVorbis(samples, smplData)
+			return [[b'LIST', b'sdta'], [
+				[b'smpl', smplData.getbuffer()]
+			]]
+
+		if self.stream:
+			# Sample data is written straight into the output file when the
+			# smpl chunk is exported. The sm24 chunk goes after it, so its
+			# data is kept in a temporary file meanwhile.
+			if self.bits == 24:
+				sm24Data = tempfile.TemporaryFile()
+				return [[b'LIST', b'sdta'], [
+					[b'smpl', lambda: self.sfSmpl(samples, self.outFile, sm24Data)],
+					[b'sm24', lambda: self.copySm24(sm24Data)]
+				]]
+			return [[b'LIST', b'sdta'], [
+				[b'smpl', lambda: self.sfSmpl(samples, self.outFile)]
+			]]
+
+		smplData = io.BytesIO()
+		if self.bits == 24:
+			sm24Data = io.BytesIO()
+			self.sfSmpl(samples, smplData, sm24Data)
+			return [[b'LIST', b'sdta'], [
+				[b'smpl', smplData.getbuffer()],
+				[b'sm24', sm24Data.getbuffer()]
+			]]
+		self.sfSmpl(samples, smplData)
+		return [[b'LIST', b'sdta'], [
+			[b'smpl', smplData.getbuffer()]
+		]]
+
+
+	def copySm24(self, sm24Data):
+		sm24Data.seek(0)
+		shutil.copyfileobj(sm24Data, self.outFile, SF2.sfBlockSize)
+		sm24Data.close()
+
+
+	def listSamples(self, soundBank):
+		# Paths of the audio samples which exportSF2 would read
+		self.soundBank = soundBank
+		self.sampleList = {}
+		self.resolveOpcodes()
+		return [samplePath for sample, samplePath, opcodes in self.collectSamples()]
+
+
+	def cacheSample(self, samplePath, cache, bits = 16):
+		# Decode an audio sample and store it in cache, if not already there
+		self.cache = cache
+		self.bits = bits
+		self.readSample(samplePath)
+
+
+	def checkSF2(self, soundBank, jobs = 1):
+		# Check that soundBank can be exported, reading only the headers of
+		# its audio samples, with up to jobs threads. Every problem found is
+		# logged, and True is returned if there is none.
+		self.initExport(soundBank, jobs = jobs)
+		self.sampleList = {}
+		self.shdrRecords = []
+		self.zoneErrors = 0
+		errors = 0
+		samples = self.collectSamples()
+
+		def readInfo(samplePath):
+			try:
+				return soundfile.info(samplePath)
+			except Exception:
+				return None
+
+		with concurrent.futures.ThreadPoolExecutor(max(jobs, 1)) as pool:
+			infos = list(pool.map(readInfo, [samplePath for sample, samplePath, opcodes in samples]))
+		sampleInfo = {}
+		for (sample, samplePath, opcodes), info in zip(samples, infos):
+			if info == None:
+				logging.error("Can not read input audio file {}".format(samplePath))
+				errors += 1
+			elif info.channels < 1 or info.frames == 0:
+				logging.error("Can not read data from audio file {}".format(samplePath))
+				errors += 1
+			elif info.channels > 2:
+				logging.error("Audio file contains more than 2 channels: {}".format(samplePath))
+				errors += 1
+			else:
+				sampleInfo[sample] = info
+				for ch in range(0, info.channels):
+					name = self.sfSampleName(sample, info.channels, ch)
+					if not self.checkName(name):
+						errors += 1
+
+		# Name of the main preset, which includes all instruments
+		if 'Instrument' in self.soundBank.keys():
+			if not self.checkName(self.soundBank['Instrument']):
+				errors += 1
+
+		# Loop points of every region, since regions which share a sample may
+		# set different ones
 		for instrument in self.soundBank['instruments']:
+			if not self.checkName(self.sfInstrumentName(instrument)):
+				errors += 1
 			for group in instrument['groups']:
-				for region in group['regions']:
-					sample = self.getOpcode('sample', instrument, group, region)
-					if not sample or sample in self.sampleList.keys():
+				for opcodes, localOpcodes in self.regionOpcodes[id(group)]:
+					info = sampleInfo.get(opcodes.get('sample'))
+					if info == None:
 						continue
+					loopStart = opcodes.get('loop_start', 0)
+					loopEnd = opcodes.get('loop_end', info.frames - 1)
+					if loopStart < 0 or loopStart > loopEnd or loopEnd >= info.frames:
+						logging.error("Invalid loop points {}-{} for the {} frames of audio file {}".format(
+							loopStart, loopEnd, info.frames, opcodes.get('sample')))
+						errors += 1
+
+		# Sample headers are created from the audio file headers, and then
+		# generators are encoded as if the sound bank was exported. Regions
+		# of samples which can not be read have no zones.
+		validSamples = [entry for entry in samples if entry[0] in sampleInfo.keys()]
+		self.sfShdrLayout(validSamples, [(sampleInfo[sample].samplerate, sampleInfo[sample].channels,
+			sampleInfo[sample].frames) for sample, samplePath, opcodes in validSamples])
+		if len(self.shdrRecords) > 65535:
+			logging.error("Too many samples for SF2 format: {}".format(len(self.shdrRecords)))
+			errors += 1
+		smplSize = sum([(info.frames + 46) * info.channels * 2 for info in sampleInfo.values()])
+		if smplSize > 0xffffffff:
+			logging.error("Sample data too large for SF2 format: {} bytes".format(smplSize))
+			errors += 1
+		# The generators of each instrument and region are checked on their
+		# own, and then the limits of the indexes
+		try:
+			self.sfPdta()
+		except SF2ExportError:
+			errors += 1
+		errors += self.zoneErrors
+		return errors == 0
+
 
+	def sfName(self, name):
+		# Names are stored as ASCII, truncated to 19 characters. When
+		# checking, names have been reported by checkName.
+		try:
+			return name.encode('ascii')[:19]
+		except UnicodeEncodeError:
+			if self.zoneErrors == None:
+				logging.error("Name contains characters other than ASCII: {}".format(name))
+				raise SF2ExportError
+			return name.encode('ascii', 'replace')[:19]
+
+
+	def checkName(self, name):
+		# Names of presets, instruments and samples must be ASCII, and are
+		# truncated to 19 characters
+		try:
+			name.encode('ascii')
+		except UnicodeEncodeError:
+			logging.error("Name contains characters other than ASCII: {}".format(name))
+			return False
+		if len(name) > 19:
+			logging.warning("Name longer than 19 characters will be truncated: {}".format(name))
+		return True
+
+
+	def collectSamples(self):
+		# Collect unique samples in the order they will be stored, so that
+		# sample indexes do not depend on the order in which they are decoded
+		samples = []
+		for instrument in self.soundBank['instruments']:
+			for group in instrument['groups']:
+				for opcodes, localOpcodes in self.regionOpcodes[id(group)]:
+					sample = opcodes.get('sample')
+					if not sample or sample in self.sampleList.keys():
+						continue
+					pitch = opcodes.get('pitch_keycenter', 60)
+					self.sampleList[sample] = [0, 0, pitch]
 					samplePath = sample
 					if not os.path.isabs(samplePath) and 'Path' in self.soundBank.keys():
 						samplePath = os.path.join(self.soundBank['Path'], sample)
-					try:
-						data, rate = soundfile.read(file=samplePath, dtype='int16', always_2d=True)
-					except:
-						logging.error("Can not read input audio file {}".format(samplePath))
-						raise SF2ExportError
-					channels = len(data[0])
-					if channels < 1:
-						logging.error("Can not read data from audio file {}".format(samplePath))
-						raise SF2ExportError
-					if channels > 2:
-						logging.error("Audio file contains more than 2 channels: {}".format(samplePath))
-						raise SF2ExportError
-
-					pitch = self.getOpcode('pitch_keycenter', instrument, group, region, 60)
-					self.sampleList[sample] = [channels, sampleIndex, pitch]
-					for ch in range(0, channels):
-						start = len(smplData) // 2
-						for n in data:
-							smplData += struct.pack('<h', n[ch])
-						end = len(smplData) // 2
-						smplData += bytes(46 * 2)
-
-						sampleType = 1 # mono sample
-						if channels == 2:
-							if ch == 0:
-								sampleType = 4 # left sample
-							else:
-								sampleType = 2 # right sample
-
-						loopMode = self.getOpcode('loop_mode', instrument, group, region, 'no_loop')
-						loopStartDefault = 0
-						loopEndDefault = end - start
-						if loopMode == 'no_loop':
-							loopStartDefault += 8
-							loopEndDefault -= 8
-						loopStart = start + self.getOpcode('loop_start', instrument, group, region, loopStartDefault)
-						loopEnd = start + self.getOpcode('loop_end', instrument, group, region, loopEndDefault)
-						name, ext = os.path.splitext(os.path.basename(sample))
-						sampleLink = 0
-						if channels == 2:
-							if ch == 0:
-								name += '_L'
-								sampleLink = sampleIndex + 1
-							else:
-								name += '_R'
-								sampleLink = sampleIndex - 1
-						self.shdrData += struct.pack('<19sBIIIIIBbHH',
-							name.encode('ascii'), 0, start, end, loopStart, loopEnd, rate, pitch, 0,
-							sampleLink, sampleType)
-						sampleIndex += 1
+					samples.append([sample, samplePath, opcodes])
+		return samples
+
+
+	def sfSmpl(self, samples, out, sm24Out = None):
+		# With sm24Out, samples are decoded as 32 bit integers: the two upper
+		# bytes of each one are written to out and the next byte to sm24Out
+		sampleIndex = 0
+		base = out.tell()
+		frameSize = 2
+		if sm24Out:
+			sm24Base = sm24Out.tell()
+			frameSize = 3
+		position = 0
+		sampleHashes = {}
+		duplicates = 0
+		savedBytes = 0
+		audioData = self.readSamples([samplePath for sample, samplePath, opcodes in samples])
+		for sample, samplePath, opcodes in samples:
+			rate, channels, channelData = next(audioData)
+			if self.trimSilence != None or self.findLoops:
+				channelData, opcodes = self.analyzeSample(opcodes, rate, channelData)
+			if self.dedup:
+				# Samples can share a header only if audio data and loop
+				# points are the same. Pitch is set by overridingRootKey.
+				loopMode = opcodes.get('loop_mode', 'no_loop')
+				sampleHash = hashlib.sha1(repr([rate, channels, loopMode == 'no_loop',
+					opcodes.get('loop_start'), opcodes.get('loop_end')]).encode('ascii'))
+
+			sampleStart = position
+			ranges = []
+			for ch in range(0, channels):
+				start = position
+				for block in channelData[ch]:
+					if sm24Out:
+						data = numpy.frombuffer(block, dtype = 'u1').reshape(-1, 4)
+						out.write(data[:, 2:4].tobytes())
+						sm24Out.write(data[:, 1].tobytes())
+						position += len(data)
+					else:
+						out.write(block)
+						position += len(block) // 2
+					if self.dedup:
+						sampleHash.update(block)
+				end = position
+				out.write(bytes(46 * 2))
+				if sm24Out:
+					sm24Out.write(bytes(46))
+				position += 46
+				ranges.append([start, end])
+
+			if self.dedup:
+				digest = sampleHash.digest()
+				if digest in sampleHashes:
+					# Discard data already written and point to the first copy
+					out.seek(base + sampleStart * 2)
+					out.truncate()
+					if sm24Out:
+						sm24Out.seek(sm24Base + sampleStart)
+						sm24Out.truncate()
+					duplicates += 1
+					savedBytes += (position - sampleStart) * frameSize
+					position = sampleStart
+					self.sampleList[sample] = self.sampleList[sampleHashes[digest]]
+					continue
+				sampleHashes[digest] = sample
+
+			self.sampleList[sample][0:2] = [channels, sampleIndex]
+			for ch in range(0, channels):
+				start, end = ranges[ch]
+				self.sfShdr(sample, opcodes, channels, ch, sampleIndex, start, end, rate)
+				sampleIndex += 1
+
+		if sm24Out and position % 2 > 0:
+			# The size of the sm24 chunk must be even
+			sm24Out.write(bytes(1))
+		if self.dedup:
+			self.logDuplicates(duplicates, savedBytes)
+		if self.stats:
+			self.stats.count('sfSdta', 'samples', len(samples))
+			self.stats.count('sfSdta', 'frames', position)
+			self.stats.count('sfSdta', 'bytes', position * frameSize)
+
+
+	def logDuplicates(self, duplicates, savedBytes):
+		# Saved bytes are those of the decoded sample data, also in SF3 files
+		logging.info("Duplicated samples removed: {}, {} bytes of sample data saved".format(
+			duplicates, savedBytes))
+
+
+	def sfSmplVorbis(self, samples, out):
+		# SF3 sample data: each channel is stored as an Ogg Vorbis stream,
+		# without padding between them. Samples are encoded by a pool of
+		# processes when there are several jobs, with limited lookahead, and
+		# written in order.
+		sampleIndex = 0
+		base = out.tell()
+		sampleHashes = {}
+		duplicates = 0
+		savedBytes = 0
+		frames = 0
+		pool = None
+		if self.jobs > 1:
+			pool = concurrent.futures.ProcessPoolExecutor(self.jobs)
+		pending = collections.deque()
+
+		def writeSample(sample, opcodes, rate, channelFrames, encoded):
+			nonlocal sampleIndex
+			channels = len(encoded)
+			self.sampleList[sample][0:2] = [channels, sampleIndex]
+			for ch in range(0, channels):
+				data = encoded[ch]
+				if pool:
+					data = data.result()
+				start = out.tell() - base
+				out.write(data)
+				self.sfShdr(sample, opcodes, channels, ch, sampleIndex, start, start + len(data), rate,
+					channelFrames)
+				sampleIndex += 1
+
+		try:
+			audioData = self.readSamples([samplePath for sample, samplePath, opcodes in samples])
+			for sample, samplePath, opcodes in samples:
+				rate, channels, channelData = next(audioData)
+				if self.trimSilence != None or self.findLoops:
+					channelData, opcodes = self.analyzeSample(opcodes, rate, channelData)
+				channelData = [[bytes(block) for block in blocks] for blocks in channelData]
+				channelFrames = sum([len(block) for block in channelData[0]]) // 2
+				frames += channelFrames * channels
+				if self.dedup:
+					loopMode = opcodes.get('loop_mode', 'no_loop')
+					sampleHash = hashlib.sha1(repr([rate, channels, loopMode == 'no_loop',
+						opcodes.get('loop_start'), opcodes.get('loop_end')]).encode('ascii'))
+					for blocks in channelData:
+						for block in blocks:
+							sampleHash.update(block)
+					digest = sampleHash.digest()
+					if digest in sampleHashes:
+						self.sampleList[sample] = self.sampleList[sampleHashes[digest]]
+						duplicates += 1
+						savedBytes += sum([len(block) for blocks in channelData for block in blocks])
+						continue
+					sampleHashes[digest] = sample
+
+				if pool:
+					encoded = [pool.submit(encodeVorbis, blocks, rate, self.quality) for blocks in channelData]
+				else:
+					encoded = [encodeVorbis(blocks, rate, self.quality) for blocks in channelData]
+				pending.append([sample, opcodes, rate, channelFrames, encoded])
+				if len(pending) >= 2 * self.jobs:
+					writeSample(*pending.popleft())
+			while pending:
+				writeSample(*pending.popleft())
+		except RuntimeError:
+			logging.error("Can not encode audio data")
+			raise SF2ExportError
+		finally:
+			if pool:
+				for sample, opcodes, rate, channelFrames, encoded in pending:
+					for future in encoded:
+						future.cancel()
+				pool.shutdown()
+
+		if (out.tell() - base) % 2 > 0:
+			out.write(bytes(1))
+		if self.dedup:
+			self.logDuplicates(duplicates, savedBytes)
+		if self.stats:
+			self.stats.count('sfSdta', 'samples', len(samples))
+			self.stats.count('sfSdta', 'frames', frames)
+			self.stats.count('sfSdta', 'bytes', out.tell() - base)
+
+
+	def analyzeSample(self, opcodes, rate, channelData):
+		# Returns the channel data without silence at its ends, and the
+		# opcodes with the loop points found or moved with the start of the
+		# sample. Explicit loop points are never trimmed.
+		with statsPhase(self.stats, 'analyze'):
+			dtype, dataType = SF2.sfSampleFormats[self.bits]
+			data = numpy.stack([numpy.frombuffer(b''.join(blocks), dtype = dataType) for blocks in channelData],
+				axis = 1)
+			frames = len(data)
+			start = 0
+			end = frames
+			loopStart = opcodes.get('loop_start')
+			loopEnd = opcodes.get('loop_end')
+			if self.trimSilence != None:
+				start, end = findSound(data, self.trimSilence)
+				if loopStart != None:
+					start = min(start, loopStart)
+				if loopEnd != None:
+					end = max(end, min(loopEnd + 1, frames))
+
+			newOpcodes = dict(opcodes)
+			for opcode in ('loop_start', 'loop_end'):
+				if opcode in newOpcodes.keys():
+					newOpcodes[opcode] -= start
+			loopMode = opcodes.get('loop_mode', 'no_loop')
+			loop = None
+			if self.findLoops and loopMode in ('loop_continuous', 'loop_sustain') \
+				and loopStart == None and loopEnd == None:
+				loop = findLoop(data[start:end], rate)
+				if loop:
+					newOpcodes['loop_start'], newOpcodes['loop_end'] = loop
+
+		if self.stats:
+			self.stats.count('analyze', 'samples')
+			self.stats.count('analyze', 'trimmedFrames', (frames - end + start) * data.shape[1])
+			if loop:
+				self.stats.count('analyze', 'loops')
+		return [[data[start:end, ch].tobytes()] for ch in range(0, data.shape[1])], newOpcodes
+
+
+	def sfShdrLayout(self, samples, layout):
+		# Create sample headers for data which is already stored, from the
+		# rate, channels and length of each sample
+		sampleIndex = 0
+		position = 0
+		for (sample, samplePath, opcodes), (rate, channels, frames) in zip(samples, layout):
+			self.sampleList[sample][0:2] = [channels, sampleIndex]
+			for ch in range(0, channels):
+				start = position
+				end = position + frames
+				position = end + 46
+				self.sfShdr(sample, opcodes, channels, ch, sampleIndex, start, end, rate)
+				sampleIndex += 1
+
+
+	def sfShdr(self, sample, opcodes, channels, ch, sampleIndex, start, end, rate, frames = None):
+		# Compressed samples (SF3) are given their number of frames: start and
+		# end are then the offsets in bytes of their data, and loop points are
+		# relative to the start of the decoded sample
+		sampleType = 1 # mono sample
+		if channels == 2:
+			if ch == 0:
+				sampleType = 4 # left sample
+			else:
+				sampleType = 2 # right sample
+		loopBase = start
+		if frames == None:
+			frames = end - start
+		else:
+			sampleType |= 0x10 # Ogg Vorbis data
+			loopBase = 0
+
+		pitch = self.sampleList[sample][2]
+		loopMode = opcodes.get('loop_mode', 'no_loop')
+		loopStartDefault = 0
+		loopEndDefault = frames
+		if loopMode == 'no_loop':
+			loopStartDefault += 8
+			loopEndDefault -= 8
+		loopStart = loopBase + opcodes.get('loop_start', loopStartDefault)
+		loopEnd = loopBase + opcodes.get('loop_end', loopEndDefault)
+		name = self.sfSampleName(sample, channels, ch)
+		sampleLink = 0
+		if channels == 2:
+			if ch == 0:
+				sampleLink = sampleIndex + 1
+			else:
+				sampleLink = sampleIndex - 1
+		self.shdrRecords.append((self.sfName(name), start, end, loopStart, loopEnd, rate, pitch, 0,
+			sampleLink, sampleType))
+
+
+	def sfSampleName(self, sample, channels, ch):
+		name, ext = os.path.splitext(os.path.basename(sample))
+		if channels == 2:
+			name += ['_L', '_R'][ch]
+		return name
 
-		return [[b'LIST', b'sdta'], [
-			[b'smpl', smplData]
-		]]
 
+	def readPreviousFile(self):
+		# Find the smpl chunk and the sample headers of an existing SF2 file
+		try:
+			data = mmap.mmap(self.previousFile.fileno(), 0, access = mmap.ACCESS_READ)
+		except (OSError, ValueError):
+			return None
+
+		smpl = None
+		shdr = None
+		try:
+			key, size, form = struct.unpack_from('<4sI4s', data, 0)
+			if key != b'RIFF' or form != b'sfbk':
+				return None
+			pos = 12
+			while pos + 12 <= len(data):
+				key, size, form = struct.unpack_from('<4sI4s', data, pos)
+				if key == b'LIST' and form in (b'sdta', b'pdta'):
+					subPos = pos + 12
+					while subPos + 8 <= pos + 8 + size:
+						subKey, subSize = struct.unpack_from('<4sI', data, subPos)
+						if form == b'sdta' and subKey == b'smpl':
+							smpl = (subPos + 8, subSize)
+						elif form == b'sdta':
+							# Other sample data (sm24) is not reused
+							return None
+						elif subKey == b'shdr':
+							shdr = []
+							for rec in range(subPos + 8, subPos + 8 + subSize - 46, 46):
+								shdr.append(struct.unpack_from('<20sIIIIIBbHH', data, rec))
+						subPos += 8 + subSize + subSize % 2
+				pos += 8 + size + size % 2
+		except struct.error:
+			return None
+		finally:
+			data.close()
 
-	def createGenList(self, instrument = None, group = None, region = None):
+		if smpl == None or shdr == None:
+			return None
+		return smpl, shdr
+
+
+	def reusableSdta(self):
+		# Duplicated samples are only known after decoding them, so previous
+		# sample data can not be reused when they are removed. Only 16 bit
+		# uncompressed sample data which has not been analyzed is reused.
+		return not self.dedup and self.bits == 16 and self.quality == None and self.trimSilence == None \
+			and not self.findLoops
+
+
+	def fileStates(self, samples):
+		# Absolute path, size and modification time of each audio file
+		states = []
+		for sample, samplePath, opcodes in samples:
+			try:
+				stat = os.stat(samplePath)
+			except OSError:
+				return None
+			states.append([os.path.abspath(samplePath), stat.st_size, stat.st_mtime_ns])
+		return states
+
+
+	def readStates(self, fileName):
+		try:
+			with open(fileName, 'r') as stateFile:
+				return json.load(stateFile)['samples']
+		except (OSError, ValueError, KeyError, TypeError):
+			return None
+
+
+	def writeStates(self, fileName, states):
+		try:
+			with open(fileName, 'w') as stateFile:
+				json.dump({'samples': states}, stateFile)
+				stateFile.write('\n')
+		except OSError:
+			logging.warning("Can not write file {}".format(fileName))
+
+
+	def checkPreviousSdta(self, samples):
+		# The previous sample data can be reused if the same audio files are
+		# used, with the same size and modification time as when it was
+		# written, and all samples have the same layout. Only audio file
+		# headers are read.
+		if self.previousStates == None or self.previousStates != self.sampleStates:
+			return None
+		previous = self.readPreviousFile()
+		if previous == None:
+			return None
+		(smplOffset, smplSize), shdr = previous
+		fileTime = os.fstat(self.previousFile.fileno()).st_mtime_ns
+
+		layout = []
+		records = []
+		position = 0
+		for sample, samplePath, opcodes in samples:
+			try:
+				if os.stat(samplePath).st_mtime_ns > fileTime:
+					return None
+				info = soundfile.info(samplePath)
+			except:
+				return None
+			layout.append((info.samplerate, info.channels, info.frames))
+			for ch in range(0, info.channels):
+				sampleName = self.sfSampleName(sample, info.channels, ch)
+				records.append((sampleName, position, position + info.frames, info.samplerate))
+				position += info.frames + 46
+
+		if len(records) != len(shdr) or smplSize != position * 2:
+			return None
+		for (name, start, end, rate), old in zip(records, shdr):
+			oldName = old[0].split(b'\0')[0]
+			if oldName != self.sfName(name) or old[1:3] != (start, end) or old[5] != rate:
+				return None
+
+		self.previousSmpl = (smplOffset, smplSize)
+		return layout
+
+
+	def copyPreviousSmpl(self):
+		offset, size = self.previousSmpl
+		self.outFile.flush()
+		inFd = self.previousFile.fileno()
+		outFd = self.outFile.fileno()
+		outPos = self.outFile.tell()
+		copied = 0
+		try:
+			while copied < size:
+				count = os.copy_file_range(inFd, outFd, size - copied, offset + copied, outPos + copied)
+				if count == 0:
+					break
+				copied += count
+		except (AttributeError, OSError):
+			pass
+
+		if copied < size:
+			# copy_file_range is not available, copy through mmap instead
+			data = mmap.mmap(inFd, 0, access = mmap.ACCESS_READ)
+			self.outFile.seek(outPos + copied)
+			self.outFile.write(memoryview(data)[offset + copied:offset + size])
+			self.outFile.flush()
+			data.close()
+		self.outFile.seek(outPos + size)
+
+
+	def readSamples(self, samplePaths):
+		if self.jobs < 2:
+			for samplePath in samplePaths:
+				yield self.readSample(samplePath, self.stream)
+			return
+
+		# Samples are decoded ahead by a pool of threads (libsndfile and numpy
+		# release the GIL), but they are always returned in the same order.
+		# Lookahead is limited to keep memory usage bounded.
+		pool = concurrent.futures.ThreadPoolExecutor(self.jobs)
+		pending = collections.deque()
+		try:
+			for samplePath in samplePaths:
+				pending.append(pool.submit(self.readSample, samplePath, False))
+				if len(pending) >= 2 * self.jobs:
+					yield pending.popleft().result()
+			while pending:
+				yield pending.popleft().result()
+		finally:
+			for future in pending:
+				future.cancel()
+			pool.shutdown()
+
+
+	def readSample(self, samplePath, stream = False):
+		dtype, dataType = SF2.sfSampleFormats[self.bits]
+		if self.cache:
+			cached = self.cache.get(samplePath, dtype, numpy.dtype(dataType).itemsize)
+			if cached:
+				if self.stats:
+					self.stats.count('decode', 'cacheHits')
+				rate, channels, channelData = cached
+				return rate, channels, [[view] for view in channelData]
+		if self.stats:
+			self.stats.count('decode', 'samples')
+
+		try:
+			audio = soundfile.SoundFile(samplePath)
+		except:
+			logging.error("Can not read input audio file {}".format(samplePath))
+			raise SF2ExportError
+		channels = audio.channels
+		if channels < 1:
+			audio.close()
+			logging.error("Can not read data from audio file {}".format(samplePath))
+			raise SF2ExportError
+		if channels > 2:
+			audio.close()
+			logging.error("Audio file contains more than 2 channels: {}".format(samplePath))
+			raise SF2ExportError
+
+		cacheWriter = None
+		if self.cache:
+			cacheWriter = self.cache.create(samplePath, dtype, audio.samplerate, channels, audio.frames)
+
+		if stream:
+			channelData = [self.readSampleBlocks(audio, samplePath, ch, cacheWriter) for ch in range(0, channels)]
+			return audio.samplerate, channels, channelData
+
+		try:
+			with statsPhase(self.stats, 'decode'):
+				data = audio.read(dtype=dtype, always_2d=True)
+		except:
+			if cacheWriter:
+				cacheWriter.abort()
+			logging.error("Can not read input audio file {}".format(samplePath))
+			raise SF2ExportError
+		finally:
+			audio.close()
+		channelData = [[data[:, ch].astype(dataType).tobytes()] for ch in range(0, channels)]
+		if self.stats:
+			self.stats.count('decode', 'frames', len(data) * channels)
+		if cacheWriter:
+			for ch in range(0, channels):
+				cacheWriter.write(channelData[ch][0])
+			cacheWriter.commit()
+		return audio.samplerate, channels, channelData
+
+
+	def readSampleBlocks(self, audio, samplePath, ch, cacheWriter = None):
+		dtype, dataType = SF2.sfSampleFormats[self.bits]
+		audio.seek(0)
+		while True:
+			try:
+				with statsPhase(self.stats, 'decode'):
+					block = audio.read(SF2.sfBlockSize, dtype=dtype, always_2d=True)
+			except:
+				audio.close()
+				if cacheWriter:
+					cacheWriter.abort()
+				logging.error("Can not read input audio file {}".format(samplePath))
+				raise SF2ExportError
+			if len(block) == 0:
+				break
+			if self.stats:
+				self.stats.count('decode', 'frames', len(block))
+			block = block[:, ch].astype(dataType).tobytes()
+			if cacheWriter:
+				cacheWriter.write(block)
+			yield block
+		if ch == audio.channels - 1:
+			audio.close()
+			if cacheWriter:
+				cacheWriter.commit()
+
+
+	def createGenList(self, opcodes):
 		genList = {}
-		genOpcodes = {
-			'delayVolEnv': 'delay',
-			'attackVolEnv': 'ampeg_attack',
-			'decayVolEnv': 'ampeg_decay',
-			'sustainVolEnv': 'ampeg_sustain',
-			'holdVolEnv': 'ampeg_hold',
-			'releaseVolEnv': 'ampeg_release',
-			'initialFilterFc': 'cutoff',
-			'initialFilterQ': 'resonance',
-			'initialAttenuation': 'volume',
-			'fineTune': 'tune',
-			'scaleTuning': 'pitch_keytrack'
-		}
-		for gen in genOpcodes.keys():
-			value = self.getOpcode(genOpcodes[gen], instrument, group, region)
+		for opcode in SF2.genOpcodes:
+			value = opcodes.get(opcode)
 			if value == None:
 				continue
-			if gen in ['delayVolEnv', 'attackVolEnv', 'decayVolEnv', 'holdVolEnv', 'releaseVolEnv']:
-				genList[gen] = self.genTime(value)
-			elif gen == 'sustainVolEnv':
-				value = float(value)
-				if value == 0:
-					genList[gen] = 1000
-				else:
-					genList[gen] = self.percentToCentibels(value)
-					if genList[gen] > 1000:
-						genList[gen] = 1000
-			elif gen == 'initialFilterFc':
-				fil_type = self.getOpcode('fil_type', instrument, group, region)
-				if fil_type == None or fil_type == 'lpf_2p':
-					genList[gen] = self.freqToAbsoluteCents(value)
-				else:
-					logging.error("SF2 format does not support filter type {}".format(fil_type))
+			spec = sfzOpcodes[opcode]
+			for required, values in spec.get('sf2Requires', {}).items():
+				requiredValue = opcodes.get(required)
+				if requiredValue != None and not requiredValue in values:
+					logging.error("SF2 format does not support {} with {}={}".format(opcode, required, requiredValue))
 					raise SF2ExportError
-			elif gen == 'initialFilterQ':
-				genList[gen] = int(float(value) * 10)
-			elif gen == 'initialAttenuation':
-				value = float(value)
-				if value > 0:
-					logging.warning("SF2 format does not support amplification (positive volume value)")
-				genList[gen] = int(-value * 10)
-			elif gen == 'fineTune':
-				genList[gen] = int(value)
-			elif gen == 'scaleTuning':
-				genList[gen] = int(value)
-
-		loopMode = self.getOpcode('loop_mode', instrument, group, region, 'no_loop')
+			genList[spec['sf2Gen']] = getattr(self, spec['sf2Value'])(value)
+
+		loopMode = opcodes.get('loop_mode', 'no_loop')
 		if loopMode == 'one_shot':
 			# Simulate one_shot mode using a large value for releaseVolEnv
 			genList['releaseVolEnv'] = self.genTime(100)
@@ -332,11 +1168,11 @@ class SF2:
 		lokeyMin = 128
 		hikeyMax = -1
 		for group in instrument['groups']:
-			for region in group['regions']:
-				lokey = self.getOpcode('lokey', instrument, group, region, 0)
+			for opcodes, localOpcodes in self.regionOpcodes[id(group)]:
+				lokey = opcodes.get('lokey', 0)
 				if lokey < lokeyMin:
 					lokeyMin = lokey
-				hikey = self.getOpcode('hikey', instrument, group, region, 127)
+				hikey = opcodes.get('hikey', 127)
 				if hikey > hikeyMax:
 					hikeyMax = hikey
 		if lokeyMin == 128:
@@ -346,18 +1182,147 @@ class SF2:
 		return lokeyMin, hikeyMax
 
 
+	def sfZones(self, opcodes, localOpcodes):
+		# Generators of the zones of a region, one for each channel of its
+		# sample. Each zone is returned as the generators which go before
+		# velRange and those which go after it, as lists of opers and amounts.
+		sample = opcodes.get('sample')
+		channels = self.sampleList[sample][0]
+		zones = []
+		for ch in range(0, channels):
+			# keyRange (if exists, it must be the first)
+			head = []
+			lokey = opcodes.get('lokey', 0)
+			hikey = opcodes.get('hikey', 127)
+			if lokey > 0 or hikey < 127:
+				head += [SF2.sfGenId['keyRange'], self.genRange(lokey, hikey)]
+
+			tail = []
+
+			# pan
+			if channels == 2:
+				if ch == 0:
+					tail += [SF2.sfGenId['pan'], self.genAmount(-500)]
+				else:
+					tail += [SF2.sfGenId['pan'], self.genAmount(500)]
+			else:
+				pan = opcodes.get('pan', 0)
+				if pan != 0:
+					tail += [SF2.sfGenId['pan'], self.genAmount(int(pan * 5))]
+
+			# sampleModes
+			loopMode = opcodes.get('loop_mode', 'no_loop')
+			sampleModes = 0
+			if loopMode == 'loop_continuous':
+				sampleModes = 1
+			elif loopMode == 'loop_sustain':
+				sampleModes = 3
+			if sampleModes != 0:
+				tail += [SF2.sfGenId['sampleModes'], sampleModes]
+
+			# overridingRootKey
+			pitch = opcodes.get('pitch_keycenter', 60)
+			if pitch != self.sampleList[sample][2]:
+				tail += [SF2.sfGenId['overridingRootKey'], self.genAmount(pitch)]
+
+			# velocity
+			ampVelTrack = opcodes.get('amp_veltrack', 100)
+			if ampVelTrack == 0:
+				tail += [SF2.sfGenId['velocity'], 127]
+
+			# other options
+			genList = self.createGenList(localOpcodes)
+			for gen in genList.keys():
+				tail += [SF2.sfGenId[gen], self.genAmount(genList[gen])]
+
+			# sampleID (it must be the last)
+			tail += [SF2.sfGenId['sampleID'], self.sampleList[sample][1] + ch]
+
+			zones.append((head, tail))
+		return zones
+
+
+	def genAmount(self, value):
+		# Generator amounts are stored as 16 bit words
+		if value < -32768 or value > 65535:
+			logging.error("Generator value out of range: {}".format(value))
+			raise SF2ExportError
+		return value & 0xffff
+
+
+	def genRange(self, lo, hi):
+		return self.genAmount(lo | hi << 8)
+
+
+	def sfIndexes(self, counts, what):
+		# Index of the first item of each record, given the number of items
+		# of each one, and of the terminal record
+		indexes = numpy.zeros(len(counts) + 1, dtype = 'int64')
+		numpy.cumsum(counts, out = indexes[1:])
+		if indexes[-1] > 65535:
+			logging.error("Too many {} for SF2 format: {}".format(what, indexes[-1]))
+			raise SF2ExportError
+		return indexes
+
+
+	def sfRecords(self, recordType, names, indexes, terminal):
+		# Header records with their names and indexes, and the terminal one
+		records = numpy.zeros(len(names) + 1, dtype = recordType)
+		records['name'][:-1] = [self.sfName(name) for name in names]
+		records['name'][-1] = terminal
+		records['bagNdx'] = indexes
+		return records
+
+
+	def sfGens(self, gens):
+		# Generator records from a list of opers and amounts, and the
+		# terminal one
+		words = numpy.zeros(len(gens) + 2, dtype = '<u2')
+		words[:-2] = gens
+		return words.view(SF2.sfGenRecord)
+
+
+	def sfBags(self, counts, what):
+		bags = numpy.zeros(len(counts) + 1, dtype = SF2.sfBagRecord)
+		bags['genNdx'] = self.sfIndexes(counts, what)
+		return bags
+
+
+	def zoneError(self):
+		# When checking a sound bank, zoneErrors counts the instruments and
+		# regions whose generators can not be encoded, which are left out so
+		# that the others are checked too. Otherwise the export fails.
+		if self.zoneErrors == None:
+			raise SF2ExportError
+		self.zoneErrors += 1
+		return []
+
+
+	def sfInstrumentName(self, instrument):
+		if 'Instrument' in instrument.keys():
+			return instrument['Instrument']
+		elif 'Instrument' in self.soundBank.keys():
+			return self.soundBank['Instrument']
+		elif 'Name' in self.soundBank.keys():
+			return self.soundBank['Name']
+		return 'Instrument'
+
+
 	def sfPdta(self):
+		# Records are collected as lists, and each sub-chunk is built at the
+		# end as an array of records. Indexes of bags and generators are the
+		# cumulative sums of the number of items of each preset, instrument
+		# or zone.
+		presetNames = []
+		presetNumbers = []
+		presetBags = []
+		pbagGens = []
+		pgens = []
+		instNames = []
+		instBags = []
+		ibagGens = []
+		igens = []
 		instNum = 0
-		pbagNdx = 0
-		pgenNdx = 0
-		ibagNdx = 0
-		igenNdx = 0
-		phdrData = bytearray()
-		pbagData = bytearray()
-		pgenData = bytearray()
-		instData = bytearray()
-		ibagData = bytearray()
-		igenData = bytearray()
 
 		if 'Instrument' in self.soundBank.keys():
 			# Create a main preset which includes all instruments
@@ -368,11 +1333,12 @@ class SF2:
 				program = self.soundBank['Program'] - 1
 			else:
 				self.nextProgram += 1
-			phdrData += struct.pack('<19sBHHHIII', instrumentName.encode('ascii'), 0, program, 0, pbagNdx, 0, 0, 0)
+			presetNames.append(instrumentName)
+			presetNumbers.append((program, 0))
+			presetBags.append(len(self.soundBank['instruments']))
 
 			for instrument in self.soundBank['instruments']:
-				pbagData += struct.pack('<HH', pgenNdx, 0)
-				pbagNdx += 1
+				genCount = len(pgens) // 2
 
 				# Instrument options (main preset)
 				# --------------------------------
@@ -380,8 +1346,7 @@ class SF2:
 				# keyRange (if exists, it must be the first)
 				keyMin, keyMax = self.getKeyRange(instrument)
 				if keyMin > 0 or keyMax < 127:
-					pgenData += struct.pack('<HBB', SF2.sfGenId['keyRange'], keyMin, keyMax)
-					pgenNdx += 1
+					pgens += [SF2.sfGenId['keyRange'], self.genRange(keyMin, keyMax)]
 
 				# velRange (if exists, it must be preceded only by keyRange)
 				lovel = 0
@@ -391,23 +1356,16 @@ class SF2:
 				if 'hivel' in instrument.keys():
 					hivel = instrument['hivel']
 				if lovel > 0 or hivel < 127:
-					pgenData += struct.pack('<HBB', SF2.sfGenId['velRange'], lovel, hivel)
-					pgenNdx += 1
+					pgens += [SF2.sfGenId['velRange'], self.genRange(lovel, hivel)]
 
 				# instrument (it must be the last)
-				pgenData += struct.pack('<HH', SF2.sfGenId['instrument'], instNum)
-				pgenNdx += 1
+				pgens += [SF2.sfGenId['instrument'], instNum]
+				pbagGens.append(len(pgens) // 2 - genCount)
 				instNum += 1
 
 		instNum = 0
 		for instrument in self.soundBank['instruments']:
-			instrumentName = 'Instrument'
-			if 'Instrument' in instrument.keys():
-				instrumentName = instrument['Instrument']
-			elif 'Instrument' in self.soundBank.keys():
-				instrumentName = self.soundBank['Instrument']
-			elif 'Name' in self.soundBank.keys():
-				instrumentName = self.soundBank['Name']
+			instrumentName = self.sfInstrumentName(instrument)
 			createPreset = True
 			program = self.nextProgram
 			if 'Program' in instrument.keys():
@@ -421,156 +1379,468 @@ class SF2:
 				bank = 0
 				if self.getOpcode('PercussionMode', instrument, default = False):
 					bank = 128
-				phdrData += struct.pack('<19sBHHHIII', instrumentName.encode('ascii'), 0,
-					program, bank, pbagNdx, 0, 0, 0)
-				pbagData += struct.pack('<HH', pgenNdx, 0)
-				pbagNdx += 1
+				presetNames.append(instrumentName)
+				presetNumbers.append((program, bank))
+				presetBags.append(1)
+				genCount = len(pgens) // 2
 
 				# keyRange (if exists, it must be the first)
 				keyMin, keyMax = self.getKeyRange(instrument)
 				if keyMin > 0 or keyMax < 127:
-					pgenData += struct.pack('<HBB', SF2.sfGenId['keyRange'], keyMin, keyMax)
-					pgenNdx += 1
+					pgens += [SF2.sfGenId['keyRange'], self.genRange(keyMin, keyMax)]
 
 				# instrument (it must be the last)
-				pgenData += struct.pack('<HH', SF2.sfGenId['instrument'], instNum)
-				pgenNdx += 1
+				pgens += [SF2.sfGenId['instrument'], instNum]
+				pbagGens.append(len(pgens) // 2 - genCount)
 				instNum += 1
 
-			instData += struct.pack('<19sBH', instrumentName.encode('ascii'), 0, ibagNdx)
+			instNames.append(instrumentName)
+			bagCount = len(ibagGens)
 
 			# Instrument options
 			# ------------------
 
-			genList = self.createGenList(instrument)
+			try:
+				gens = []
+				genList = self.createGenList(instrument)
+				for gen in genList.keys():
+					gens += [SF2.sfGenId[gen], self.genAmount(genList[gen])]
+			except SF2ExportError:
+				gens = self.zoneError()
 
-			if len(genList) > 0:
+			if len(gens) > 0:
 				# Create a global zone for this instrument
-				ibagData += struct.pack('<HH', igenNdx, 0)
-				ibagNdx += 1
-
-			for gen in genList.keys():
-				igenData += struct.pack('<H{}'.format(SF2.sfGenType[gen]), SF2.sfGenId[gen], genList[gen])
-				igenNdx += 1
+				ibagGens.append(len(gens) // 2)
+				igens += gens
 
 			for group in instrument['groups']:
-				lovel = 0
-				hivel = 127
-				vel = 0
-				randomRegion = False
+				# Generators of each zone are created once, and only velRange
+				# changes between the copies of regions in random groups
+				regionZones = []
+				for opcodes, localOpcodes in self.regionOpcodes[id(group)]:
+					if opcodes.get('sample'):
+						try:
+							regionZones.append((localOpcodes, self.sfZones(opcodes, localOpcodes)))
+						except SF2ExportError:
+							self.zoneError()
+
 				if self.getOpcode('RandomRegion', None, group, default = False):
+					# Each copy of a region plays at a single velocity, from
+					# hivel down to lovel
 					lovel = self.getOpcode('lovel', None, group, default = 0)
-					hivel = self.getOpcode('hivel', None, group, default = 127)
-					vel = hivel
-					randomRegion = True
-
-				repeat = True
-				while repeat:
-					for region in group['regions']:
-						sample = self.getOpcode('sample', instrument, group, region)
-						if not sample:
-							continue
-
-						channels = self.sampleList[sample][0]
-						for ch in range(0, channels):
-							ibagData += struct.pack('<HH', igenNdx, 0)
-							ibagNdx += 1
-
-							# Zone options
-							# ------------
-
-							# keyRange (if exists, it must be the first)
-							lokey = self.getOpcode('lokey', instrument, group, region, 0)
-							hikey = self.getOpcode('hikey', instrument, group, region, 127)
-							if lokey > 0 or hikey < 127:
-								igenData += struct.pack('<HBB', SF2.sfGenId['keyRange'], lokey, hikey)
-								igenNdx += 1
-
-							# velRange (if exists, it must be preceded only by keyRange)
-							if randomRegion:
-								igenData += struct.pack('<HBB', SF2.sfGenId['velRange'], vel, vel)
-								igenNdx += 1
-							else:
-								lovel = self.getOpcode('lovel', None, group, region, 0)
-								hivel = self.getOpcode('hivel', None, group, region, 127)
-								if lovel > 0 or hivel < 127:
-									igenData += struct.pack('<HBB', SF2.sfGenId['velRange'], lovel, hivel)
-									igenNdx += 1
-
-							# pan
-							if channels == 2:
-								if ch == 0:
-									igenData += struct.pack('<Hh', SF2.sfGenId['pan'], -500)
-								else:
-									igenData += struct.pack('<Hh', SF2.sfGenId['pan'], 500)
-								igenNdx += 1
-							else:
-								pan = self.getOpcode('pan', instrument, group, region, 0)
-								if pan != 0:
-									igenData += struct.pack('<Hh', SF2.sfGenId['pan'], int(pan * 5))
-									igenNdx += 1
-
-							# sampleModes
-							loopMode = self.getOpcode('loop_mode', instrument, group, region, 'no_loop')
-							sampleModes = 0
-							if loopMode == 'loop_continuous':
-								sampleModes = 1
-							elif loopMode == 'loop_sustain':
-								sampleModes = 3
-							if sampleModes != 0:
-								igenData += struct.pack('<HH', SF2.sfGenId['sampleModes'], sampleModes)
-								igenNdx += 1
-
-							# overridingRootKey
-							pitch = self.getOpcode('pitch_keycenter', instrument, group, region, 60)
-							if pitch != self.sampleList[sample][2]:
-								igenData += struct.pack('<Hh', SF2.sfGenId['overridingRootKey'], pitch)
-								igenNdx += 1
-
-							# velocity
-							ampVelTrack = self.getOpcode('amp_veltrack', instrument, group, region, 100)
-							if ampVelTrack == 0:
-								igenData += struct.pack('<HH', SF2.sfGenId['velocity'], 127)
-								igenNdx += 1
-
-							# other options
-							genList = self.createGenList(None, group, region)
-							for gen in genList.keys():
-								igenData += struct.pack('<H{}'.format(SF2.sfGenType[gen]), SF2.sfGenId[gen], genList[gen])
-								igenNdx += 1
-
-							# sampleID (it must be the last)
-							igenData += struct.pack('<HH', SF2.sfGenId['sampleID'], self.sampleList[sample][1] + ch)
-							igenNdx += 1
-
-						if randomRegion:
+					vel = self.getOpcode('hivel', None, group, default = 127)
+					while vel >= lovel and len(regionZones) > 0:
+						for localOpcodes, zones in regionZones:
+							velRange = [SF2.sfGenId['velRange'], self.genRange(vel, vel)]
+							for head, tail in zones:
+								zone = head + velRange + tail
+								ibagGens.append(len(zone) // 2)
+								igens += zone
 							vel -= 1
 							if vel < lovel:
-								repeat = False
 								break
+					continue
+
+				for localOpcodes, zones in regionZones:
+					# velRange (if exists, it must be preceded only by keyRange)
+					velRange = []
+					lovel = localOpcodes.get('lovel', 0)
+					hivel = localOpcodes.get('hivel', 127)
+					if lovel > 0 or hivel < 127:
+						velRange = [SF2.sfGenId['velRange'], self.genRange(lovel, hivel)]
+					for head, tail in zones:
+						zone = head + velRange + tail
+						ibagGens.append(len(zone) // 2)
+						igens += zone
+
+			instBags.append(len(ibagGens) - bagCount)
+
+		phdr = self.sfRecords(SF2.sfPhdrRecord, presetNames, self.sfIndexes(presetBags, 'preset zones'), b'EOP')
+		if len(presetNumbers) > 0:
+			phdr[['preset', 'bank']][:-1] = presetNumbers
+		pbag = self.sfBags(pbagGens, 'preset generators')
+		pmod = numpy.zeros(1, dtype = SF2.sfModRecord)
+		pgen = self.sfGens(pgens)
+		inst = self.sfRecords(SF2.sfInstRecord, instNames, self.sfIndexes(instBags, 'instrument zones'), b'EOI')
+		ibag = self.sfBags(ibagGens, 'instrument generators')
+		imod = numpy.zeros(1, dtype = SF2.sfModRecord)
+		igen = self.sfGens(igens)
+		shdr = numpy.zeros(len(self.shdrRecords) + 1, dtype = SF2.sfShdrRecord)
+		if len(self.shdrRecords) > 0:
+			shdr[:-1] = self.shdrRecords
+		shdr['name'][-1] = b'EOS'
+
+		chunks = [[b'phdr', phdr], [b'pbag', pbag], [b'pmod', pmod], [b'pgen', pgen], [b'inst', inst],
+			[b'ibag', ibag], [b'imod', imod], [b'igen', igen], [b'shdr', shdr]]
+		if self.stats:
+			self.stats.count('sfPdta', 'zones', len(ibag) - 1)
+			self.stats.count('sfPdta', 'bytes', sum([records.nbytes for key, records in chunks]))
+		return [[b'LIST', b'pdta'], [[key, records.tobytes()] for key, records in chunks]]
+
+
+	def importSF2(self, fileName):
+		self.soundBank = {'instruments': []}
+		self.samples = None
+		self.sampleFiles = {}
+		self.sampleNames = {}
+		self.clampedOpcodes = set()
+		try:
+			inFile = open(fileName, 'rb')
+		except:
+			logging.error("Can not open file: {}".format(fileName))
+			return False
+		try:
+			# The file is never read as a whole: presets are parsed from the
+			# mapped pdta chunk, and sample data is only accessed on demand
+			self.inData = mmap.mmap(inFile.fileno(), 0, access = mmap.ACCESS_READ)
+		except (OSError, ValueError):
+			logging.error("Can not read file: {}".format(fileName))
+			return False
+		finally:
+			inFile.close()
+
+		try:
+			with statsPhase(self.stats, 'importSF2'):
+				chunks = self.readChunks()
+				self.readInfo(chunks)
+				self.readShdr(chunks)
+				self.readPresets(chunks)
+			if self.stats:
+				self.stats.count('importSF2', 'bytes', len(self.inData))
+		except (SF2ImportError, IndexError, ValueError, struct.error):
+			logging.error("Invalid or unsupported SF2 file: {}".format(fileName))
+			return False
+		return True
 
-					if not randomRegion:
-						repeat = False
-
-		phdrData += struct.pack('<20sHHHIII', b'EOP', 0, 0, pbagNdx, 0, 0, 0)
-		pbagData += struct.pack('<HH', pgenNdx, 0)
-		pmodData = struct.pack('<HHhHH', 0, 0, 0, 0, 0)
-		pgenData += struct.pack('<HH', 0, 0)
-		instData += struct.pack('<20sH', b'EOI', ibagNdx)
-		ibagData += struct.pack('<HH', igenNdx, 0)
-		imodData = struct.pack('<HHhHH', 0, 0, 0, 0, 0)
-		igenData += struct.pack('<HH', 0, 0)
-		self.shdrData += struct.pack('<20sIIIIIBbHH', b'EOS', 0, 0, 0, 0, 0, 0, 0, 0, 0)
-
-		return [[b'LIST', b'pdta'], [
-			[b'phdr', phdrData],
-			[b'pbag', pbagData],
-			[b'pmod', pmodData],
-			[b'pgen', pgenData],
-			[b'inst', instData],
-			[b'ibag', ibagData],
-			[b'imod', imodData],
-			[b'igen', igenData],
-			[b'shdr', self.shdrData]
-		]]
 
+	def readChunks(self):
+		data = self.inData
+		if len(data) < 12 or data[0:4] != b'RIFF' or data[8:12] != b'sfbk':
+			raise SF2ImportError
+		chunks = {}
+		pos = 12
+		while pos + 12 <= len(data):
+			key, size, form = struct.unpack_from('<4sI4s', data, pos)
+			listEnd = pos + 8 + size
+			if listEnd > len(data):
+				raise SF2ImportError
+			if key == b'LIST':
+				subPos = pos + 12
+				while subPos + 8 <= listEnd:
+					subKey, subSize = struct.unpack_from('<4sI', data, subPos)
+					if subPos + 8 + subSize > listEnd:
+						raise SF2ImportError
+					chunks[subKey] = (subPos + 8, subSize)
+					subPos += 8 + subSize + subSize % 2
+			pos = listEnd + size % 2
+
+		for key in (b'smpl', b'phdr', b'pbag', b'pgen', b'inst', b'ibag', b'igen', b'shdr'):
+			if not key in chunks.keys():
+				raise SF2ImportError
+		return chunks
+
+
+	def readRecords(self, chunks, key, recordType):
+		offset, size = chunks[key]
+		return numpy.frombuffer(self.inData, dtype = recordType,
+			count = size // recordType.itemsize, offset = offset)
+
+
+	def readString(self, string):
+		return bytes(string).split(b'\0')[0].decode('ascii', 'replace').strip()
+
+
+	def readInfo(self, chunks):
+		for key, hint in ((b'INAM', 'Name'), (b'ICRD', 'Date'), (b'IENG', 'Author'), (b'ICMT', 'URL')):
+			if not key in chunks.keys():
+				continue
+			offset, size = chunks[key]
+			value = self.readString(self.inData[offset:offset + size])
+			if len(value) == 0:
+				continue
+			if hint == 'Date':
+				try:
+					value = dateutil.parser.parse(value).strftime('%Y-%m-%d')
+				except:
+					continue
+			elif hint == 'URL':
+				if not value.startswith(('http://', 'https://', 'ftp://', 'file:')):
+					continue
+			self.soundBank[hint] = value
+
+
+	def readShdr(self, chunks):
+		self.smplOffset, smplSize = chunks[b'smpl']
+		# The last record is the terminal EOS sample
+		self.samples = self.readRecords(chunks, b'shdr', SF2.sfShdrRecord)[:-1]
+		if len(self.samples) > 0 and self.samples['end'].max() > smplSize // 2:
+			raise SF2ImportError
+
+
+	def sampleView(self, sampleID):
+		# Sample data of a mono sample or a single channel, as a read only
+		# array backed by the mapped file
+		sample = self.samples[sampleID]
+		start = int(sample['start'])
+		end = int(sample['end'])
+		return numpy.frombuffer(self.inData, dtype = '<i2', count = end - start,
+			offset = self.smplOffset + start * 2)
+
+
+	def readZones(self, bags, gens, firstBag, lastBag, lastGen):
+		# Returns the global zone and the other zones of a preset or
+		# instrument, each one as a dict of generator values
+		globalZone = {}
+		zones = []
+		for bag in range(firstBag, lastBag):
+			zone = {}
+			for gen in gens[bags[bag]['genNdx']:bags[bag + 1]['genNdx']]:
+				zone[int(gen['oper'])] = int(gen['amount'])
+			if lastGen in zone.keys():
+				zones.append(zone)
+			elif bag == firstBag:
+				globalZone = zone
+		return globalZone, zones
+
+
+	def readPresets(self, chunks):
+		phdr = self.readRecords(chunks, b'phdr', SF2.sfPhdrRecord)
+		pbag = self.readRecords(chunks, b'pbag', SF2.sfBagRecord)
+		pgen = self.readRecords(chunks, b'pgen', SF2.sfGenRecord)
+		inst = self.readRecords(chunks, b'inst', SF2.sfInstRecord)
+		ibag = self.readRecords(chunks, b'ibag', SF2.sfBagRecord)
+		igen = self.readRecords(chunks, b'igen', SF2.sfGenRecord)
+
+		for presetNum in range(0, len(phdr) - 1):
+			preset = phdr[presetNum]
+			instrument = {'Instrument': self.readString(preset['name']), 'groups': []}
+			if preset['preset'] < 128:
+				instrument['Program'] = int(preset['preset']) + 1
+			if preset['bank'] == 128:
+				instrument['PercussionMode'] = True
+
+			presetGlobal, presetZones = self.readZones(pbag, pgen, preset['bagNdx'],
+				phdr[presetNum + 1]['bagNdx'], SF2.sfGenId['instrument'])
+			for presetZone in presetZones:
+				instNum = presetZone[SF2.sfGenId['instrument']]
+				if instNum >= len(inst) - 1:
+					raise SF2ImportError
+				ranges = dict(presetGlobal)
+				ranges.update(presetZone)
+				instGlobal, zones = self.readZones(ibag, igen, inst[instNum]['bagNdx'],
+					inst[instNum + 1]['bagNdx'], SF2.sfGenId['sampleID'])
+				group = self.readGroup(instGlobal, zones, ranges)
+				if len(group['regions']) > 0:
+					instrument['groups'].append(group)
+
+			if len(instrument['groups']) > 0:
+				self.soundBank['instruments'].append(instrument)
+
+
+	def readGroup(self, instGlobal, zones, presetRanges):
+		group = self.clampOpcodes(self.genToOpcodes(instGlobal))
+		group['regions'] = []
+
+		# Right samples of stereo pairs are merged with their left sample
+		leftSamples = set()
+		for zone in zones:
+			sampleID = zone[SF2.sfGenId['sampleID']]
+			if sampleID < len(self.samples) and self.samples[sampleID]['type'] == 4:
+				leftSamples.add(sampleID)
+
+		for zone in zones:
+			sampleID = zone[SF2.sfGenId['sampleID']]
+			if sampleID >= len(self.samples):
+				logging.warning("Ignoring zone with invalid sample number: {}".format(sampleID))
+				continue
+			sample = self.samples[sampleID]
+			sampleType = int(sample['type'])
+			link = int(sample['link'])
+			if sampleType & 0x8000:
+				logging.warning("Ignoring ROM sample: {}".format(self.readString(sample['name'])))
+				continue
+			if sampleType == 2 and link in leftSamples:
+				continue
+			stereo = sampleType == 4 and link < len(self.samples) and self.samples[link]['type'] == 2
+
+			genValues = dict(instGlobal)
+			genValues.update(zone)
+			region = self.genToOpcodes(zone)
+
+			# Key and velocity ranges of the preset zone limit those of the
+			# instrument zone
+			skip = False
+			for gen, loOpcode, hiOpcode in (('keyRange', 'lokey', 'hikey'), ('velRange', 'lovel', 'hivel')):
+				genNum = SF2.sfGenId[gen]
+				if not genNum in presetRanges.keys():
+					continue
+				value = genValues.get(genNum, 0x7f00)
+				lo = max(value & 0xff, presetRanges[genNum] & 0xff)
+				hi = min(value >> 8, presetRanges[genNum] >> 8)
+				if lo > hi:
+					skip = True
+				region[loOpcode] = lo
+				region[hiOpcode] = hi
+			if skip:
+				continue
+
+			if stereo and 'pan' in region.keys():
+				del region['pan']
+			if not SF2.sfGenId['overridingRootKey'] in genValues.keys():
+				region['pitch_keycenter'] = int(sample['pitch']) if sample['pitch'] <= 127 else 60
+			if sample['correction'] != 0:
+				region['tune'] = self.getOpcode('tune', None, group, region, 0) + int(sample['correction'])
+
+			loopMode = genValues.get(SF2.sfGenId['sampleModes'], 0) & 3
+			if loopMode == 1 or loopMode == 3:
+				loopStart = int(sample['loopStart']) - int(sample['start']) \
+					+ self.genSigned(genValues.get(SF2.sfGenId['startloopAddrsOffset'], 0)) \
+					+ self.genSigned(genValues.get(SF2.sfGenId['startloopAddrsCoarseOffset'], 0)) * 32768
+				loopEnd = int(sample['loopEnd']) - int(sample['start']) \
+					+ self.genSigned(genValues.get(SF2.sfGenId['endloopAddrsOffset'], 0)) \
+					+ self.genSigned(genValues.get(SF2.sfGenId['endloopAddrsCoarseOffset'], 0)) * 32768
+				region['loop_start'] = loopStart
+				region['loop_end'] = loopEnd
+
+			region['sample'] = self.sampleFile(sampleID, stereo)
+			group['regions'].append(self.clampOpcodes(region))
+		return group
+
+
+	def sampleFile(self, sampleID, stereo):
+		# Name of the audio file which will hold a sample, or a stereo pair
+		if (sampleID, stereo) in self.sampleNames.keys():
+			return self.sampleNames[(sampleID, stereo)]
+		sampleIDs = [sampleID]
+		name = self.readString(self.samples[sampleID]['name'])
+		if stereo:
+			sampleIDs.append(int(self.samples[sampleID]['link']))
+			if name[-2:] in ('_L', '-L'):
+				name = name[:-2]
+		name = re.sub('[^a-zA-Z0-9_.#+-]', '_', name)
+		if len(name) == 0:
+			name = 'sample'
+		fileName = name + '.wav'
+		if fileName in self.sampleFiles.keys():
+			fileName = '{}_{}.wav'.format(name, sampleID)
+		self.sampleFiles[fileName] = sampleIDs
+		self.sampleNames[(sampleID, stereo)] = fileName
+		return fileName
+
+
+	def genSigned(self, value):
+		if value > 32767:
+			return value - 65536
+		return value
+
+
+	def genTimeToSeconds(self, value):
+		value = self.genSigned(value)
+		if value == -32768:
+			return 0
+		return round(2 ** (value / 1200), 3)
+
+
+	def clampOpcodes(self, opcodes):
+		# Values beyond the range of their SFZ opcode, which the SFZ importer
+		# would reject, are clamped to it, with a warning for each opcode
+		for opcode, value in opcodes.items():
+			spec = sfzOpcodes[opcode]
+			if spec['type'] == 'note':
+				minValue, maxValue = 0, 127
+			elif spec['type'] in ('int', 'float'):
+				minValue, maxValue = spec['min'], spec['max']
+			else:
+				continue
+			if value >= minValue and value <= maxValue:
+				continue
+			if not opcode in self.clampedOpcodes:
+				logging.warning("Value of {} out of the SFZ range, clamped to {}-{}: {}".format(
+					opcode, minValue, maxValue, value))
+				self.clampedOpcodes.add(opcode)
+			opcodes[opcode] = min(max(value, minValue), maxValue)
+		return opcodes
+
+
+	def genToOpcodes(self, gens):
+		opcodes = {}
+		timeOpcodes = {
+			SF2.sfGenId['delayVolEnv']: 'delay',
+			SF2.sfGenId['attackVolEnv']: 'ampeg_attack',
+			SF2.sfGenId['holdVolEnv']: 'ampeg_hold',
+			SF2.sfGenId['decayVolEnv']: 'ampeg_decay',
+			SF2.sfGenId['releaseVolEnv']: 'ampeg_release'
+		}
+		for gen, value in gens.items():
+			if gen == SF2.sfGenId['keyRange']:
+				opcodes['lokey'] = value & 0xff
+				opcodes['hikey'] = value >> 8
+			elif gen == SF2.sfGenId['velRange']:
+				opcodes['lovel'] = value & 0xff
+				opcodes['hivel'] = value >> 8
+			elif gen == SF2.sfGenId['pan']:
+				opcodes['pan'] = self.genSigned(value) / 5
+			elif gen == SF2.sfGenId['sampleModes']:
+				opcodes['loop_mode'] = ['no_loop', 'loop_continuous', 'no_loop', 'loop_sustain'][value & 3]
+			elif gen == SF2.sfGenId['overridingRootKey']:
+				if value <= 127:
+					opcodes['pitch_keycenter'] = value
+			elif gen == SF2.sfGenId['initialAttenuation']:
+				opcodes['volume'] = -self.genSigned(value) / 10
+			elif gen == SF2.sfGenId['fineTune']:
+				opcodes['tune'] = self.genSigned(value)
+			elif gen == SF2.sfGenId['scaleTuning']:
+				opcodes['pitch_keytrack'] = self.genSigned(value)
+			elif gen == SF2.sfGenId['initialFilterFc']:
+				opcodes['cutoff'] = round(440 * 2 ** ((self.genSigned(value) - 6900) / 1200), 1)
+			elif gen == SF2.sfGenId['initialFilterQ']:
+				opcodes['resonance'] = self.genSigned(value) / 10
+			elif gen == SF2.sfGenId['sustainVolEnv']:
+				value = self.genSigned(value)
+				if value >= 1000:
+					opcodes['ampeg_sustain'] = 0
+				else:
+					opcodes['ampeg_sustain'] = round(100 / 10 ** (value / 200), 2)
+			elif gen in timeOpcodes.keys():
+				opcodes[timeOpcodes[gen]] = self.genTimeToSeconds(value)
+			elif gen == SF2.sfGenId['velocity']:
+				if value == 127:
+					opcodes['amp_veltrack'] = 0
+		return opcodes
+
+
+	def exportSamples(self, path, jobs = 1):
+		# Write each sample, or stereo pair, referenced by the imported
+		# sound bank to a WAV file. Data is read in blocks from the mapped
+		# input file, and files are written by a pool of threads.
+		with statsPhase(self.stats, 'exportSamples'):
+			pool = concurrent.futures.ThreadPoolExecutor(max(jobs, 1))
+			futures = []
+			for fileName in self.sampleFiles.keys():
+				futures.append(pool.submit(self.exportSample, os.path.join(path, fileName),
+					self.sampleFiles[fileName]))
+			pool.shutdown()
+		return all([future.result() for future in futures])
+
+
+	def exportSample(self, fileName, sampleIDs):
+		channels = [self.sampleView(sampleID) for sampleID in sampleIDs]
+		frames = min([len(channel) for channel in channels])
+		if len(channels) > 1 and len(channels[0]) != len(channels[1]):
+			logging.warning("Stereo samples have different length: {}".format(fileName))
+		rate = int(self.samples[sampleIDs[0]]['rate'])
+		try:
+			with soundfile.SoundFile(fileName, 'w', rate, len(channels), 'PCM_16') as outFile:
+				for start in range(0, frames, SF2.sfBlockSize):
+					end = min(start + SF2.sfBlockSize, frames)
+					if len(channels) == 1:
+						outFile.write(channels[0][start:end])
+					else:
+						outFile.write(numpy.stack([channel[start:end] for channel in channels], axis = 1))
+		except:
+			logging.error("Can not write audio file {}".format(fileName))
+			return False
+		if self.stats:
+			self.stats.count('exportSamples', 'samples')
+			self.stats.count('exportSamples', 'frames', frames * len(channels))
+		return True
@@ -14,6 +14,9 @@
 
 import logging, re, os.path, sys
 import dateutil.parser
+from opcodes import sfzOpcodes
+from compactbank import SampleTable, CompactRegions
+from stats import statsPhase
 
 
 class SFZParseError(Exception):
@@ -24,11 +27,36 @@ class SFZ:
 
 	noteValue = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
 
-
-	def importSFZ(self, fileName):
+	hintRegEx = re.compile(r'//\+ ([a-zA-Z0-9_&.+-]+): +(\S.*)$')
+
+	# Each match of tokenRegEx is a header, an opcode with its value, or any
+	# other character, which is a syntax error. The value of an opcode ends
+	# before a header, before the next opcode (a name preceded by whitespace
+	# and followed by '='), or at the end of the line.
+	tokenRegEx = re.compile(r'''\s*(?:
+		<(?P<header>[^>]*)> |
+		(?P<opcode>[^=<\s][^=]*)=
+		(?P<value>[^=<]*(?=<) | [^=<]*$ | .*?(?=\s[a-zA-Z0-9_]+=)) |
+		(?P<error>\S)
+	)''', re.VERBOSE | re.DOTALL)
+
+	intRegEx = re.compile('^-?[0-9]+$')
+	floatRegEx = re.compile('^-?[0-9]*.?[0-9]+$')
+	noteNumRegEx = re.compile('^[0-9]{1,3}$')
+	noteNameRegEx = re.compile('^([abcdefgABCDEFG])([b#]?)(-?[0-9])$')
+
+	# Statistics of each phase are recorded here if set (see stats.py)
+	stats = None
+
+
+	def importSFZ(self, fileName, compact = False):
+		# With compact, regions are stored in CompactRegions instead of dicts
+		self.sampleTable = None
+		if compact:
+			self.sampleTable = SampleTable()
 		self.soundBank = {'instruments': []}
 		self.instrument = {'groups': []}
-		self.group = {'regions': []}
+		self.group = {'regions': self.newRegions()}
 		self.region = {}
 		self.insideInstrument = False
 		self.insideGroup = False
@@ -43,19 +71,24 @@ class SFZ:
 			self.soundBank['Path'] = path
 
 		lineNumber = 0
-		for line in inFile:
-			lineNumber += 1
-			try:
-				self.processLine(line)
-			except SFZParseError:
-				logging.error("Error on line {} of file {}".format(lineNumber, fileName))
-				inFile.close()
-				return False
-
-		self.commitRegion()
-		self.commitGroup()
-		self.commitInstrument()
+		with statsPhase(self.stats, 'importSFZ'):
+			for line in inFile:
+				lineNumber += 1
+				try:
+					self.processLine(line)
+				except SFZParseError:
+					logging.error("Error on line {} of file {}".format(lineNumber, fileName))
+					inFile.close()
+					return False
+
+			self.commitRegion()
+			self.commitGroup()
+			self.commitInstrument()
 		inFile.close()
+		if self.stats:
+			self.stats.count('importSFZ', 'lines', lineNumber)
+			self.stats.count('importSFZ', 'regions', sum(len(group['regions'])
+				for instrument in self.soundBank['instruments'] for group in instrument['groups']))
 		return True
 
 
@@ -68,109 +101,90 @@ class SFZ:
 			if hint in self.soundBank.keys():
 				outFile.write('//+ {}: {}\n'.format(hint, self.soundBank[hint]))
 
-		for instrument in self.soundBank['instruments']:
-			if len(self.soundBank['instruments']) > 1 or len(instrument) > 1:
-				outFile.write('\n<global>\n')
-				for instKey in sorted(instrument.keys()):
-					if instKey[0].isupper():
-						outFile.write(' //+ {}: {}\n'.format(instKey, instrument[instKey]))
-					elif instKey != 'groups':
-						outFile.write(' {}={}\n'.format(instKey, instrument[instKey]))
-			for group in instrument['groups']:
-				outFile.write('\n<group>\n')
-				for groupKey in sorted(group.keys()):
-					if groupKey != 'regions':
-						outFile.write(' {}={}\n'.format(groupKey, group[groupKey]))
-				for region in group['regions']:
-					outFile.write('<region>\n')
-
-					# if hikey, lokey and pitch_keycenter are set to the same value,
-					# write a single key opcode
-					hikey = 127
-					lokey = 0
-					pitch = 60
-					if 'hikey' in region.keys():
-						hikey = region['hikey']
-					if 'lokey' in region.keys():
-						lokey = region['lokey']
-					if 'pitch_keycenter' in region.keys():
-						pitch = region['pitch_keycenter']
-					if hikey == lokey and hikey == pitch:
-						outFile.write(' key={}\n'.format(region['hikey']))
-					else:
-						if lokey != 0:
-							outFile.write(' lokey={}\n'.format(lokey))
-						if hikey != 127:
-							outFile.write(' hikey={}\n'.format(hikey))
+		with statsPhase(self.stats, 'exportSFZ'):
+			for instrument in self.soundBank['instruments']:
+				if len(self.soundBank['instruments']) > 1 or len(instrument) > 1:
+					outFile.write('\n<global>\n')
+					for instKey in sorted(instrument.keys()):
+						if instKey[0].isupper():
+							outFile.write(' //+ {}: {}\n'.format(instKey, self.formatHint(instrument[instKey])))
+						elif instKey != 'groups':
+							outFile.write(' {}={}\n'.format(instKey, instrument[instKey]))
+				for group in instrument['groups']:
+					outFile.write('\n<group>\n')
+					for groupKey in sorted(group.keys()):
+						if groupKey[0].isupper():
+							outFile.write(' //+ {}: {}\n'.format(groupKey, self.formatHint(group[groupKey])))
+						elif groupKey != 'regions':
+							outFile.write(' {}={}\n'.format(groupKey, group[groupKey]))
+					for region in group['regions']:
+						outFile.write('<region>\n')
+
+						# if hikey, lokey and pitch_keycenter are set to the same value,
+						# write a single key opcode
+						hikey = 127
+						lokey = 0
+						pitch = 60
+						if 'hikey' in region.keys():
+							hikey = region['hikey']
+						if 'lokey' in region.keys():
+							lokey = region['lokey']
 						if 'pitch_keycenter' in region.keys():
-							outFile.write(' pitch_keycenter={}\n'.format(pitch))
-
-					for regionKey in sorted(region.keys()):
-						if regionKey == 'hikey' \
-						or regionKey == 'lokey' \
-						or regionKey == 'pitch_keycenter':
-							continue
-						outFile.write(' {}={}\n'.format(regionKey, region[regionKey]))
+							pitch = region['pitch_keycenter']
+						if hikey == lokey and hikey == pitch:
+							outFile.write(' key={}\n'.format(region['hikey']))
+						else:
+							if lokey != 0:
+								outFile.write(' lokey={}\n'.format(lokey))
+							if hikey != 127:
+								outFile.write(' hikey={}\n'.format(hikey))
+							if 'pitch_keycenter' in region.keys():
+								outFile.write(' pitch_keycenter={}\n'.format(pitch))
+
+						for regionKey in sorted(region.keys()):
+							if regionKey == 'hikey' \
+							or regionKey == 'lokey' \
+							or regionKey == 'pitch_keycenter':
+								continue
+							outFile.write(' {}={}\n'.format(regionKey, region[regionKey]))
+		if self.stats and fileName:
+			self.stats.count('exportSFZ', 'bytes', outFile.tell())
 		outFile.close()
 		return True
 
 
+	def formatHint(self, value):
+		if value is True:
+			return 'Yes'
+		elif value is False:
+			return 'No'
+		return value
+
+
 	def processLine(self, line):
-		match = re.search('//\+ ([a-zA-Z0-9_&.+-]+): +(\S.*)$', line)
-		if match:
-			value = match.group(2)
-			value = value.rstrip()
-			return self.processHint(match.group(1), value)
+		if '//+' in line:
+			match = SFZ.hintRegEx.search(line)
+			if match:
+				value = match.group(2)
+				value = value.rstrip()
+				return self.processHint(match.group(1), value)
 
 		line = line.partition('//')[0] # Erase comments
 		line = line.rstrip()
 
-		while True:
-			line = line.lstrip()
-			if len(line) == 0:
-				return True
-
-			# Header
-			if line[0] == '<':
-				end = line.find('>')
-				if end == -1:
-					raise SFZParseError
-				header = line[1:end]
-				if len(header) < 1:
-					raise SFZParseError
-				self.processHeader(header)
-				line = line[end+1:]
-				continue
-
-			# Opcode
-			end = line.find('=')
-			if end == -1:
-				raise SFZParseError
-			opcode = line[:end]
-			if len(opcode) < 1:
-				raise SFZParseError
-			line = line[end+1:]
-			if len(line) == 0:
-				raise SFZParseError
+		tokens = SFZ.tokenRegEx.findall(line)
+		if line.endswith('='):
+			# Last opcode has no value
+			tokens[-1] = ('', '', '', '=')
 
-			# Find next opcode or header
-			match = re.search('[=<]', line)
-			if not match:
-				return self.processOpcode(opcode, line)
-
-			if line[match.start()] == '=':
-				nextOpcode = re.search('\s[a-zA-Z0-9_]+=', line)
-				if not nextOpcode:
-					raise SFZParseError
-				value = line[:nextOpcode.start()].rstrip()
-				line = line[nextOpcode.start():]
+		for header, opcode, value, error in tokens:
+			if opcode:
+				self.processOpcode(opcode, value.rstrip())
+			elif header:
+				self.processHeader(header)
 			else:
-				value = line[:match.start()].rstrip()
-				line = line[match.start():]
-
-			self.processOpcode(opcode, value)
-
-		return False
+				raise SFZParseError
+		return True
 
 
 	def processHeader(self, header):
@@ -222,7 +236,13 @@ class SFZ:
 			and not self.getOpcode('loop_mode', self.instrument, self.group):
 				self.group['loop_mode'] = 'loop_continuous'
 			self.instrument['groups'].append(self.group)
-		self.group = {'regions': []}
+		self.group = {'regions': self.newRegions()}
+
+
+	def newRegions(self):
+		if self.sampleTable != None:
+			return CompactRegions(self.sampleTable)
+		return []
 
 
 	def commitRegion(self):
@@ -236,64 +256,28 @@ class SFZ:
 
 
 	def processOpcode(self, opcode, value):
-		if opcode == 'sample':
-			value = os.path.normpath(value.replace('\\', '/'))
-		elif opcode == 'lokey' \
-		or opcode == 'hikey' \
-		or opcode == 'pitch_keycenter':
-			value = self.convertNote(value)
-		elif opcode == 'key':
-			value = self.convertNote(value)
-			self.addOpcode('hikey', value)
-			self.addOpcode('lokey', value)
-			self.addOpcode('pitch_keycenter', value)
+		spec = sfzOpcodes.get(opcode)
+		if spec == None:
+			logging.warning("Unknown opcode: {}".format(opcode))
 			return True
-		elif opcode == 'lovel' \
-		or opcode == 'hivel':
-			value = self.convertNumberI(value, -1, 127)
-		elif opcode == 'volume':
-			value = self.convertNumberF(value, -144, 6)
-		elif opcode == 'tune':
-			value = self.convertNumberI(value, -100, 100)
-		elif opcode == 'pitch_keytrack':
-			value = self.convertNumberI(value, -1200, 1200)
-		elif opcode == 'ampeg_attack' \
-		or opcode == 'ampeg_decay' \
-		or opcode == 'ampeg_sustain' \
-		or opcode == 'ampeg_hold' \
-		or opcode == 'ampeg_release':
-			value = self.convertNumberF(value, 0, 100)
-		elif opcode == 'loop_start' \
-		or opcode == 'loop_end':
-			value = self.convertNumberI(value, 0, 4294967296)
-		elif opcode == 'loop_mode':
-			if not value in ['no_loop', 'one_shot', 'loop_continuous', 'loop_sustain']:
-				logging.error("Unknown parameter for loop_mode: {}".format(value))
-				raise SFZParseError
-		elif opcode == 'fil_type':
-			if not value in ['lpf_1p', 'hpf_1p', 'lpf_2p', 'hpf_2p', 'bpf_2p', 'brf_2p']:
-				logging.error("Unknown parameter for fil_type: {}".format(value))
+
+		valueType = spec['type']
+		if valueType == 'int':
+			value = self.convertNumberI(value, spec['min'], spec['max'])
+		elif valueType == 'float':
+			value = self.convertNumberF(value, spec['min'], spec['max'])
+		elif valueType == 'note':
+			value = self.convertNote(value)
+		elif valueType == 'enum':
+			if not value in spec['values']:
+				logging.error("Unknown parameter for {}: {}".format(opcode, value))
 				raise SFZParseError
-		elif opcode == 'cutoff':
-			value = self.convertNumberF(value, 0, 2822400)
-		elif opcode == 'resonance':
-			value = self.convertNumberF(value, 0, 40)
-		elif opcode == 'delay':
-			value = self.convertNumberF(value, 0, 100)
-		elif opcode == 'lorand':
-			value = self.convertNumberF(value, 0, 1)
-		elif opcode == 'hirand':
-			value = self.convertNumberF(value, 0, 1)
-		elif opcode == 'pan':
-			value = self.convertNumberF(value, -100, 100)
-		elif opcode == 'seq_length':
-			value = self.convertNumberI(value, 1, 100)
-		elif opcode == 'seq_position':
-			value = self.convertNumberI(value, 1, 100)
-		elif opcode == 'amp_veltrack':
-			value = self.convertNumberF(value, -100, 100)
-		else:
-			logging.warning("Unknown opcode: {}".format(opcode))
+		elif valueType == 'path':
+			value = os.path.normpath(value.replace('\\', '/'))
+
+		if 'sets' in spec:
+			for setOpcode in spec['sets']:
+				self.addOpcode(setOpcode, value)
 			return True
 
 		self.addOpcode(opcode, value)
@@ -352,7 +336,7 @@ class SFZ:
 
 
 	def convertNumberI(self, numS, minVal, maxVal):
-		if not re.search('^-?[0-9]+$', numS):
+		if not SFZ.intRegEx.search(numS):
 			raise SFZParseError
 		num = int(numS)
 		if num < minVal or num > maxVal:
@@ -361,7 +345,7 @@ class SFZ:
 
 
 	def convertNumberF(self, numS, minVal, maxVal):
-		if not re.search('^-?[0-9]*.?[0-9]+$', numS):
+		if not SFZ.floatRegEx.search(numS):
 			raise SFZParseError
 		num = float(numS)
 		if num < minVal or num > maxVal:
@@ -376,12 +360,12 @@ class SFZ:
 		raise SFZParseError
 
 	def convertNote(self, note):
-		if re.search('^[0-9]{1,3}$', note):
+		if SFZ.noteNumRegEx.search(note):
 			noteNum = int(note)
 			if noteNum >= 0 and noteNum <= 127:
 				return noteNum;
 
-		match = re.search('^([abcdefgABCDEFG])([b#]?)(-?[0-9])$', note)
+		match = SFZ.noteNameRegEx.search(note)
 		if not match:
 			raise SFZParseError
 		noteNum = SFZ.noteValue[match.group(1).upper()]
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+#
+# Copyright 2016, roberto@zenvoid.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# Statistics of the phases of a conversion. SFZ and SF2 objects record them
+# when their stats attribute holds a Stats object:
+#
+#   stats = Stats()
+#   sf2 = SF2()
+#   sf2.stats = stats
+#   sf2.exportSF2(soundBank, 'out.sf2')
+#   stats.writeReport('stats.json')
+#
+# Each phase records its wall time, the number of times it was entered, the
+# peak RSS of the process when it finished, and counters such as bytes,
+# frames or samples. Phases may be nested (decode is part of sfSdta), and the
+# time of phases run by several threads at once is added up.
+
+import time, json, resource, threading, contextlib, cProfile, collections, sys
+
+
+class Stats:
+
+	def __init__(self, profilePhase = None):
+		self.phases = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.start = time.perf_counter()
+		self.profilePhase = profilePhase
+		self.profile = None
+		self.profileThread = None
+		if profilePhase:
+			self.profile = cProfile.Profile()
+
+
+	def record(self, name):
+		record = self.phases.get(name)
+		if record == None:
+			record = {'seconds': 0.0, 'calls': 0}
+			self.phases[name] = record
+		return record
+
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		# Only one thread at a time can be profiled
+		profiling = False
+		if name == self.profilePhase:
+			with self.lock:
+				if self.profileThread == None:
+					self.profileThread = threading.get_ident()
+					profiling = True
+		if profiling:
+			self.profile.enable()
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			seconds = time.perf_counter() - start
+			if profiling:
+				self.profile.disable()
+				self.profileThread = None
+			peakRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+			with self.lock:
+				record = self.record(name)
+				record['seconds'] += seconds
+				record['calls'] += 1
+				record['peakRSS'] = peakRSS
+
+
+	def count(self, name, counter, value = 1):
+		with self.lock:
+			record = self.record(name)
+			record[counter] = record.get(counter, 0) + value
+
+
+	def report(self):
+		return {
+			'seconds': time.perf_counter() - self.start,
+			'peakRSS': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+			'phases': self.phases
+		}
+
+
+	def writeReport(self, fileName):
+		# Write the report as JSON, to standard output if fileName is '-'
+		if fileName == '-':
+			json.dump(self.report(), sys.stdout, indent = 2)
+			sys.stdout.write('\n')
+			return
+		with open(fileName, 'w') as outFile:
+			json.dump(self.report(), outFile, indent = 2)
+			outFile.write('\n')
+
+
+	def writeProfile(self, fileName):
+		# Save profile data of the selected phase, to be read with pstats
+		if self.profile:
+			self.profile.dump_stats(fileName)
+
+
+def statsPhase(stats, name):
+	# Context manager which records a phase, or does nothing without stats
+	if stats:
+		return stats.phase(name)
+	return contextlib.nullcontext()
@@ -0,0 +1,39 @@
+#
+# Copyright 2016, roberto@zenvoid.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# Notes, velocities and round robins guessed from the names of audio files.
+
+import unittest
+from createSFZ import parseName
+
+
+class ParseNameTest(unittest.TestCase):
+
+	def testNames(self):
+		names = {
+			'kick_1_60.wav': (60, 127, 0),
+			'Strings_01_72.wav': (72, 127, 0),
+			'snare_38.wav': (38, 127, 0),
+			'piano_60_2.wav': (60, 127, 2),
+			'piano_60v96_3.wav': (60, 96, 3),
+			'piano_C4vL_2.wav': (60, 42, 2),
+			'piano_C#4.wav': (61, 127, 0),
+			'noise.wav': (None, 127, 0)
+		}
+		for name, expected in names.items():
+			with self.subTest(name = name):
+				self.assertEqual(parseName(name), expected)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,62 @@
+#
+# Copyright 2016, roberto@zenvoid.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# Sound banks converted with several jobs, and in streaming mode, must be
+# identical to those converted with a single job.
+
+import os.path, tempfile, unittest
+from sfz import SFZ
+from sf2 import SF2
+from benchmarks.generate import generateSamples, generateSFZ
+
+
+class ParallelTest(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		# Mono and stereo samples of different lengths, used by plain and
+		# RandomRegion groups
+		cls.tmpDir = tempfile.TemporaryDirectory(prefix = 'freepats-test-')
+		path = cls.tmpDir.name
+		sampleNames = generateSamples(path, 12, frames = 5000)
+		stereoPath = os.path.join(path, 'stereo')
+		os.mkdir(stereoPath)
+		sampleNames += [os.path.join('stereo', fileName) for fileName in
+			generateSamples(stereoPath, 7, frames = 3001, channels = 2)]
+		cls.sfzFile = os.path.join(path, 'input.sfz')
+		generateSFZ(cls.sfzFile, sampleNames, instruments = 2, groups = 3, regions = 11, randomGroups = 1)
+
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.tmpDir.cleanup()
+
+
+	def convert(self, stream, jobs):
+		sfz = SFZ()
+		self.assertTrue(sfz.importSFZ(self.sfzFile))
+		fileName = os.path.join(self.tmpDir.name, 'output-{}-{}.sf2'.format(stream, jobs))
+		self.assertTrue(SF2().exportSF2(sfz.soundBank, fileName, stream = stream, jobs = jobs))
+		with open(fileName, 'rb') as sf2File:
+			return sf2File.read()
+
+
+	def testParallel(self):
+		serial = self.convert(False, 1)
+		for stream, jobs in [(False, 4), (True, 1), (True, 4)]:
+			with self.subTest(stream = stream, jobs = jobs):
+				self.assertEqual(self.convert(stream, jobs), serial)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,74 @@
+#
+# Copyright 2016, roberto@zenvoid.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# SFZ files written from SF2 files must be accepted by the SFZ importer, even
+# when generator values are beyond the range of SFZ opcodes.
+
+import os.path, tempfile, unittest
+from sfz import SFZ
+from sf2 import SF2
+from benchmarks.generate import generateSamples
+
+
+class SF2ImportTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpDir = tempfile.TemporaryDirectory(prefix = 'freepats-test-')
+		path = self.tmpDir.name
+		sampleNames = generateSamples(path, 3, frames = 5000)
+		self.sfzFile = os.path.join(path, 'input.sfz')
+		with open(self.sfzFile, 'w') as sfzFile:
+			# one_shot is stored as a release time a bit longer than 100 s
+			sfzFile.write('<group> loop_mode=one_shot resonance=40 tune=100\n')
+			for key, sampleName in enumerate(sampleNames):
+				sfzFile.write('<region> key={} sample={}\n'.format(60 + key, sampleName))
+
+
+	def tearDown(self):
+		self.tmpDir.cleanup()
+
+
+	def testReimport(self):
+		sfz = SFZ()
+		self.assertTrue(sfz.importSFZ(self.sfzFile))
+		sf2File = os.path.join(self.tmpDir.name, 'output.sf2')
+		self.assertTrue(SF2().exportSF2(sfz.soundBank, sf2File))
+
+		outPath = os.path.join(self.tmpDir.name, 'output')
+		os.mkdir(outPath)
+		sf2 = SF2()
+		self.assertTrue(sf2.importSF2(sf2File))
+		sfz = SFZ()
+		sfz.soundBank = sf2.soundBank
+		sfz.exportSFZ(os.path.join(outPath, 'output.sfz'))
+		self.assertTrue(sf2.exportSamples(outPath))
+
+		sfz = SFZ()
+		self.assertTrue(sfz.importSFZ(os.path.join(outPath, 'output.sfz')))
+		regions = sfz.soundBank['instruments'][0]['groups'][0]['regions']
+		self.assertEqual(len(regions), 3)
+		for region in regions:
+			self.assertEqual(region['ampeg_release'], 100)
+
+
+	def testClamp(self):
+		sf2 = SF2()
+		sf2.clampedOpcodes = set()
+		opcodes = sf2.clampOpcodes({'resonance': 96.0, 'tune': -130, 'loop_start': -20, 'loop_end': 400,
+			'pitch_keycenter': 60, 'loop_mode': 'loop_continuous'})
+		self.assertEqual(opcodes, {'resonance': 40, 'tune': -100, 'loop_start': 0, 'loop_end': 400,
+			'pitch_keycenter': 60, 'loop_mode': 'loop_continuous'})
+
+
+if __name__ == '__main__':
+	unittest.main()
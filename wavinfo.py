@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+#
+# Copyright 2016, roberto@zenvoid.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# Sampler information stored in WAV files. Only chunk headers and the smpl
+# and inst chunks are read, audio data is skipped.
+
+import struct, logging
+
+
+def readWavInfo(fileName):
+	# Returns a dict which may contain:
+	#
+	#   pitch: MIDI note of the original pitch (smpl or inst chunk)
+	#   loops: list of [loopType, start, end], with end included in the loop
+	#
+	# or None if the file can not be read or it is not a WAV file
+	info = {}
+	try:
+		inFile = open(fileName, 'rb')
+	except OSError:
+		logging.error("Can not open file: {}".format(fileName))
+		return None
+	with inFile:
+		header = inFile.read(12)
+		if len(header) < 12 or header[0:4] != b'RIFF' or header[8:12] != b'WAVE':
+			return None
+		while True:
+			chunkHeader = inFile.read(8)
+			if len(chunkHeader) < 8:
+				break
+			key, size = struct.unpack('<4sI', chunkHeader)
+			if key == b'smpl' and size >= 36:
+				readSmpl(inFile.read(size), info)
+			elif key == b'inst' and size >= 7:
+				readInst(inFile.read(size), info)
+			else:
+				inFile.seek(size, 1)
+			# Chunks are aligned to 16 bits
+			if size % 2 > 0:
+				inFile.seek(1, 1)
+	return info
+
+
+def readSmpl(data, info):
+	(manufacturer, product, samplePeriod, unityNote, pitchFraction, smpteFormat, smpteOffset,
+		numLoops, samplerData) = struct.unpack_from('<IIIIIIIII', data)
+	if unityNote <= 127:
+		info['pitch'] = unityNote
+	loops = []
+	for i in range(0, numLoops):
+		offset = 36 + i * 24
+		if offset + 24 > len(data):
+			break
+		cuePoint, loopType, start, end, fraction, playCount = struct.unpack_from('<IIIIII', data, offset)
+		loops.append([loopType, start, end])
+	if len(loops) > 0:
+		info['loops'] = loops
+
+
+def readInst(data, info):
+	# The smpl chunk takes precedence if both are present
+	unshiftedNote, fineTune, gain, loKey, hiKey, loVel, hiVel = struct.unpack_from('<BbbBBBB', data)
+	if not 'pitch' in info and unshiftedNote <= 127:
+		info['pitch'] = unshiftedNote